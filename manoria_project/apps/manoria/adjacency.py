@@ -0,0 +1,66 @@
+# the order neighbors have always been visited in (it decides which
+# neighbor gets which share of a building's production)
+NEIGHBOR_OFFSETS = [
+    (1, 0),
+    (-1, 0),
+    (0, 1),
+    (0, -1),
+    (1, 1),
+    (-1, -1),
+    (1, -1),
+    (-1, 1),
+]
+
+
+class SettlementGrid(object):
+    """
+    A settlement's terrain and buildings loaded once into an in-memory grid
+    so cell and neighbor lookups need no further queries.
+    """
+    
+    def __init__(self, settlement, terrain=(), buildings=()):
+        self.settlement = settlement
+        self.size = settlement.size
+        self.terrain = {}
+        self.buildings = {}
+        for cell in terrain:
+            self.terrain[(cell.x, cell.y)] = cell
+        for building in buildings:
+            self.add_building(building)
+    
+    @classmethod
+    def load(cls, settlement):
+        """
+        Loads the grid of the settlement in two queries.
+        """
+        terrain = settlement.terrain.all()
+        buildings = settlement.settlementbuilding_set.all()
+        return cls(settlement, terrain, buildings)
+    
+    def contains(self, x, y):
+        SX, SY = self.size
+        return 1 <= x <= SX and 1 <= y <= SY
+    
+    def terrain_at(self, x, y):
+        return self.terrain.get((x, y))
+    
+    def building_at(self, x, y):
+        return self.buildings.get((x, y))
+    
+    def add_building(self, building):
+        self.buildings[(building.x, building.y)] = building
+    
+    def neighbors(self, x, y, kind=None):
+        """
+        The terrain surrounding the cell at x, y (optionally only terrain of
+        the given kind).
+        """
+        found = []
+        for dx, dy in NEIGHBOR_OFFSETS:
+            terrain = self.terrain.get((x + dx, y + dy))
+            if terrain is None:
+                continue
+            if kind is not None and terrain.kind_id != kind.pk:
+                continue
+            found.append(terrain)
+        return found
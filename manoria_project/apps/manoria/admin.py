@@ -21,4 +21,7 @@ admin.site.register(models.SettlementTerrainKind)
 admin.site.register(models.SettlementTerrain)
 admin.site.register(models.SettlementTerrainResourceCount,
     list_display = ["pk", "kind", "terrain", "count", "timestamp", "natural_rate", "rate_adjustment", "rate"]
-)
\ No newline at end of file
+)
+admin.site.register(models.LeaderboardEntry,
+    list_display = ["pk", "metric", "player", "settlement", "count", "rate", "timestamp", "valid_until"]
+)
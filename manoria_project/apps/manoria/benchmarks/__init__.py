@@ -0,0 +1,137 @@
+import time
+
+from django.core.management import call_command
+from django.db import connection, reset_queries
+from django.test.client import Client
+
+from django.contrib.auth.models import User
+
+from manoria import clock
+from manoria.adjacency import SettlementGrid
+from manoria.catalog import get_catalog
+from manoria.models import Continent, Player, PlayerResourceCount, Settlement
+from manoria.models import SettlementResourceCount
+from manoria.utils import bulk_insert
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows; peak memory goes unreported there
+    resource = None
+
+
+def max_rss():
+    """
+    The peak resident memory of the process so far in kilobytes (None if
+    it cannot be told).
+    """
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class World(object):
+    """
+    A world of the given number of simulated players (see simulate_world)
+    plus a logged in benchmark player whose settlements never run short of
+    resources.
+    """
+    
+    password = "benchmark"
+    
+    def __init__(self, size, seed=0):
+        self.size = size
+        call_command("simulate_world", players=size, seed=seed, prefix="world", verbosity=0)
+        user = User(username="benchmark")
+        user.set_password(self.password)
+        user.save()
+        self.player = Player.objects.create(user=user, name="benchmark")
+        bulk_insert(PlayerResourceCount, [
+            PlayerResourceCount(player=self.player, kind_id=kind.pk, count=0,
+                natural_rate=0, rate_adjustment=0, limit=0, timestamp=clock.now()
+            )
+            for kind in get_catalog().resource_kind_list(player=True)
+        ])
+        self.client = Client()
+        self.client.login(username=user.username, password=self.password)
+        self.settlement = self.new_settlement()
+        # the simulated settlement with the longest history
+        self.busiest = Settlement.objects.filter(name__startswith="world").order_by("-building_count", "pk")[0]
+    
+    def continent(self):
+        """
+        A continent with room for another settlement.
+        """
+        for continent in Continent.objects.order_by("pk"):
+            if continent.free_count is None or continent.free_count > 0:
+                return continent
+        return Continent.objects.create(name="benchmark %d" % Continent.objects.count())
+    
+    def new_settlement(self):
+        settlement = Settlement(name="benchmark", player=self.player, continent=self.continent())
+        settlement.place()
+        SettlementResourceCount.objects.filter(settlement=settlement).update(count=10 ** 8)
+        return settlement
+    
+    def free_cell(self):
+        """
+        A cell of the benchmark settlement a building can go on, moving on
+        to a new settlement once it is full.
+        """
+        grid = SettlementGrid.load(self.settlement)
+        SX, SY = grid.size
+        for x in range(1, SX + 1):
+            for y in range(1, SY + 1):
+                if grid.terrain_at(x, y) is None and grid.building_at(x, y) is None:
+                    return x, y
+        self.settlement = self.new_settlement()
+        return self.free_cell()
+
+
+class Benchmark(object):
+    """
+    A hot path measured in a world. prepare() sets up (untimed) one call and
+    returns it; run() times the calls, counts their queries and notes how
+    far they pushed the peak memory of the process up.
+    """
+    
+    name = None
+    
+    # most queries a single call may issue (None if there is no limit)
+    query_limit = None
+    
+    def __init__(self, world):
+        self.world = world
+    
+    def prepare(self, i):
+        raise NotImplementedError
+    
+    def run(self, repeat):
+        timings, queries = [], []
+        rss = max_rss()
+        for i in range(repeat):
+            call = self.prepare(i)
+            reset_queries()
+            start = time.time()
+            call()
+            timings.append(1000 * (time.time() - start))
+            queries.append(len(connection.queries))
+        if rss is not None:
+            rss = max_rss() - rss
+        return {
+            "benchmark": self.name,
+            "size": self.world.size,
+            "calls": repeat,
+            "time_ms": {
+                "mean": sum(timings) / len(timings),
+                "min": min(timings),
+                "max": max(timings),
+            },
+            "queries": {
+                "mean": float(sum(queries)) / len(queries),
+                "min": min(queries),
+                "max": max(queries),
+            },
+            "peak_memory_growth_kb": rss,
+            "query_limit": self.query_limit,
+        }
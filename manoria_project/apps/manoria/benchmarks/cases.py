@@ -0,0 +1,119 @@
+from django.core.urlresolvers import reverse
+
+from manoria.benchmarks import Benchmark
+from manoria.catalog import get_catalog
+from manoria.models import Settlement, SettlementBuilding, SettlementResourceCount
+from manoria.models import SettlementTerrainResourceCount
+from manoria.rendering import MapRenderer
+
+
+# queries SettlementBuilding.queue() may issue whatever the size of the
+# settlement's history or the number of neighbors (without a shared grid)
+QUEUE_QUERY_LIMIT = 32
+
+# queries Settlement.place() may issue (the first placement on a continent
+# included); its writes are batched so this does not depend on the size of
+# the settlement
+PLACE_QUERY_LIMIT = 24
+
+
+class Place(Benchmark):
+    name = "Settlement.place"
+    query_limit = PLACE_QUERY_LIMIT
+    
+    def prepare(self, i):
+        settlement = Settlement(name="place%d" % i, player=self.world.player, continent=self.world.continent())
+        return settlement.place
+
+
+class Queue(Benchmark):
+    name = "SettlementBuilding.queue"
+    query_limit = QUEUE_QUERY_LIMIT
+    
+    def prepare(self, i):
+        x, y = self.world.free_cell()
+        kinds = get_catalog().building_kind_list()
+        building = SettlementBuilding(settlement=self.world.settlement, kind_id=kinds[i % len(kinds)].pk, x=x, y=y)
+        return building.queue
+
+
+class Current(Benchmark):
+    name = "BaseResourceCount.current"
+    
+    def prepare(self, i):
+        kinds = get_catalog().resource_kind_list(player=False)
+        kind = kinds[i % len(kinds)]
+        settlement = self.world.busiest
+        return lambda: SettlementResourceCount.current(kind, settlement=settlement)
+
+
+class CalculateExtremum(Benchmark):
+    name = "BaseResourceCount.calculate_extremum"
+    
+    def prepare(self, i):
+        rows = SettlementTerrainResourceCount.objects.filter(terrain__settlement=self.world.busiest)
+        rows = list(rows.values_list("terrain", "kind").distinct().order_by("terrain", "kind"))
+        terrain_id, kind_id = rows[i % len(rows)]
+        return lambda: SettlementTerrainResourceCount.calculate_extremum(kind_id, terrain=terrain_id)
+
+
+class RenderMap(Benchmark):
+    name = "render_map"
+    
+    def prepare(self, i):
+        # rendered afresh rather than from the cache
+        settlement = Settlement.objects.get(pk=self.world.busiest.pk)
+        renderer = MapRenderer(settlement)
+        return renderer.render_cells
+
+
+class View(Benchmark):
+    """
+    A GET of a view by the benchmark player.
+    """
+    
+    url_name = None
+    
+    def url(self):
+        return reverse(self.url_name)
+    
+    def prepare(self, i):
+        url = self.url()
+        def get():
+            response = self.world.client.get(url)
+            if response.status_code != 200:
+                raise AssertionError("%s answered %d" % (url, response.status_code))
+        return get
+
+
+class LeaderboardView(View):
+    name = "views.leaderboard"
+    url_name = "leaderboard"
+
+
+class ResourceCountView(View):
+    name = "views.ajax_resource_count"
+    url_name = "ajax_resource_count"
+    
+    def url(self):
+        return reverse(self.url_name, args=(self.world.settlement.pk,))
+
+
+class BuildingCreateView(View):
+    name = "views.building_create"
+    url_name = "building_create"
+    
+    def url(self):
+        return reverse(self.url_name, args=(self.world.settlement.pk,))
+
+
+BENCHMARKS = [
+    Place,
+    Queue,
+    Current,
+    CalculateExtremum,
+    RenderMap,
+    LeaderboardView,
+    ResourceCountView,
+    BuildingCreateView,
+]
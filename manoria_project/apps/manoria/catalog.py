@@ -0,0 +1,234 @@
+import threading
+import time
+
+from django.core.signals import request_started
+from django.db.models import F
+
+
+# the catalog version is kept in the database (rather than in a cache which
+# other processes may not share) so an edit made in one process reaches all
+# the others on their next request
+VERSION_PK = 1
+
+# seconds a process goes on trusting its catalog before it checks the
+# version again at the start of a request; edits made in another process
+# take up to this long to reach it
+VERSION_CHECK_INTERVAL = 5
+
+
+class Record(object):
+    """
+    An immutable, slotted copy of a row of game data. Quacks enough like
+    the model instance it was copied from (pk, unicode) for templates and
+    lookups to take either.
+    """
+    
+    __slots__ = ["id"]
+    
+    def __init__(self, **kwargs):
+        for name in self.__slots__:
+            object.__setattr__(self, name, kwargs.pop(name))
+        if kwargs:
+            raise TypeError("unexpected fields: %s" % ", ".join(kwargs))
+    
+    def __setattr__(self, name, value):
+        raise AttributeError("%s records are read-only" % type(self).__name__)
+    
+    @property
+    def pk(self):
+        return self.id
+    
+    def __eq__(self, other):
+        return type(self) is type(other) and self.id == other.id
+    
+    def __ne__(self, other):
+        return not self == other
+    
+    def __hash__(self):
+        return hash((type(self), self.id))
+    
+    def __unicode__(self):
+        return self.name
+    
+    def __str__(self):
+        return self.name.encode("utf-8")
+
+
+class ResourceKindRecord(Record):
+    __slots__ = ["id", "name", "slug", "player"]
+
+
+class TerrainKindRecord(Record):
+    __slots__ = ["id", "name", "slug", "buildable_on", "produces"]
+
+
+class BuildingKindRecord(Record):
+    __slots__ = ["id", "name", "slug", "build_time", "costs", "running_costs", "products"]
+
+
+class BuildingCostRecord(Record):
+    __slots__ = ["id", "resource_kind", "amount"]
+    
+    def __unicode__(self):
+        return u"%d of %s" % (self.amount, self.resource_kind)
+
+
+class BuildingRunningCostRecord(Record):
+    __slots__ = ["id", "resource_kind", "rate"]
+    
+    def __unicode__(self):
+        return u"%s of %s/hr" % (self.rate, self.resource_kind)
+
+
+class ProductRecord(Record):
+    __slots__ = ["id", "resource_kind", "source_terrain_kind", "base_rate"]
+    
+    def __unicode__(self):
+        return u"%s at %d/hr" % (self.resource_kind, self.base_rate)
+
+
+class Catalog(object):
+    """
+    The static game data (resource, terrain and building kinds with their
+    costs and products) loaded once into records indexed by id and by
+    slug. Lists keep the order the database returns rows in by id.
+    """
+    
+    def __init__(self):
+        # models reads the catalog (and wires up invalidate) so is imported
+        # late here
+        from manoria.models import BuildingCost, BuildingKind, BuildingKindProduct
+        from manoria.models import BuildingRunningCost, ResourceKind, SettlementTerrainKind
+        
+        self.resource_kinds = {}
+        self.resource_kinds_by_slug = {}
+        for kind in ResourceKind.objects.order_by("id"):
+            record = ResourceKindRecord(id=kind.id, name=kind.name, slug=kind.slug, player=kind.player)
+            self.resource_kinds[record.id] = self.resource_kinds_by_slug[record.slug] = record
+        
+        produces = {}
+        through = SettlementTerrainKind.produces.through
+        for settlementterrainkind_id, resourcekind_id in through.objects.order_by("id").values_list(
+            "settlementterrainkind_id", "resourcekind_id"
+        ):
+            produces.setdefault(settlementterrainkind_id, []).append(self.resource_kinds[resourcekind_id])
+        self.terrain_kinds = {}
+        self.terrain_kinds_by_slug = {}
+        for kind in SettlementTerrainKind.objects.order_by("id"):
+            record = TerrainKindRecord(id=kind.id, name=kind.name, slug=kind.slug,
+                buildable_on=kind.buildable_on,
+                produces=tuple(produces.get(kind.id, ())),
+            )
+            self.terrain_kinds[record.id] = self.terrain_kinds_by_slug[record.slug] = record
+        
+        costs, running_costs, products = {}, {}, {}
+        for cost in BuildingCost.objects.order_by("id"):
+            costs.setdefault(cost.building_kind_id, []).append(BuildingCostRecord(
+                id=cost.id,
+                resource_kind=self.resource_kinds[cost.resource_kind_id],
+                amount=cost.amount,
+            ))
+        for cost in BuildingRunningCost.objects.order_by("id"):
+            running_costs.setdefault(cost.building_kind_id, []).append(BuildingRunningCostRecord(
+                id=cost.id,
+                resource_kind=self.resource_kinds[cost.resource_kind_id],
+                rate=cost.rate,
+            ))
+        for product in BuildingKindProduct.objects.order_by("id"):
+            products.setdefault(product.building_kind_id, []).append(ProductRecord(
+                id=product.id,
+                resource_kind=self.resource_kinds[product.resource_kind_id],
+                source_terrain_kind=self.terrain_kinds.get(product.source_terrain_kind_id),
+                base_rate=product.base_rate,
+            ))
+        self.building_kinds = {}
+        self.building_kinds_by_slug = {}
+        for kind in BuildingKind.objects.order_by("id"):
+            record = BuildingKindRecord(id=kind.id, name=kind.name, slug=kind.slug,
+                build_time=kind.build_time,
+                costs=tuple(costs.get(kind.id, ())),
+                running_costs=tuple(running_costs.get(kind.id, ())),
+                products=tuple(products.get(kind.id, ())),
+            )
+            self.building_kinds[record.id] = self.building_kinds_by_slug[record.slug] = record
+    
+    def _ordered(self, records):
+        return [records[pk] for pk in sorted(records)]
+    
+    def resource_kind_list(self, player=None):
+        """
+        Resource kinds by id; only player (or only non-player) kinds if
+        player is given.
+        """
+        kinds = self._ordered(self.resource_kinds)
+        if player is not None:
+            kinds = [kind for kind in kinds if kind.player == player]
+        return kinds
+    
+    def terrain_kind_list(self):
+        return self._ordered(self.terrain_kinds)
+    
+    def building_kind_list(self):
+        return self._ordered(self.building_kinds)
+
+
+_lock = threading.Lock()
+_catalog = None
+_version = None
+_checked = None
+
+
+def _stored_version():
+    from manoria.models import CatalogVersion
+    versions = CatalogVersion.objects.filter(pk=VERSION_PK).values_list("version", flat=True)
+    if versions:
+        return versions[0]
+    return 0
+
+
+def get_catalog():
+    """
+    The process-wide catalog, loaded on first use.
+    """
+    global _catalog, _version, _checked
+    catalog = _catalog
+    if catalog is None:
+        _lock.acquire()
+        try:
+            if _catalog is None:
+                _version = _stored_version()
+                _checked = time.time()
+                _catalog = Catalog()
+            catalog = _catalog
+        finally:
+            _lock.release()
+    return catalog
+
+
+def invalidate(**kwargs):
+    """
+    Drops the catalog of this process and tells the others to do the same;
+    connected to saves and deletes of the game data.
+    """
+    from manoria.models import CatalogVersion
+    global _catalog
+    _catalog = None
+    CatalogVersion.objects.get_or_create(pk=VERSION_PK)
+    CatalogVersion.objects.filter(pk=VERSION_PK).update(version=F("version") + 1)
+
+
+def check_version(sender, **kwargs):
+    """
+    Drops the catalog at the start of a request if another process has
+    invalidated it since it was loaded. The version is read at most once
+    every VERSION_CHECK_INTERVAL seconds.
+    """
+    global _catalog, _checked
+    if _catalog is None or time.time() - _checked < VERSION_CHECK_INTERVAL:
+        return
+    _checked = time.time()
+    if _stored_version() != _version:
+        _catalog = None
+
+
+request_started.connect(check_version)
@@ -0,0 +1,120 @@
+import datetime
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import request_finished, request_started
+
+
+class Clock(object):
+    """
+    Game time as told by the wall clock.
+    """
+    
+    speed = 1
+    
+    def now(self):
+        return datetime.datetime.now()
+    
+    def seconds(self, delta):
+        """
+        The real seconds a span of game time takes to pass.
+        """
+        return (delta.days * 86400 + delta.seconds + delta.microseconds / 1000000.0) / self.speed
+
+
+class SimulatedClock(Clock):
+    """
+    Game time which is start (the real time if None) at the real time
+    origin (when the clock is made if None) and passes speed times as fast
+    as real time; a speed of 0 stops it so it only moves when advanced.
+    Lets simulations and balance tests play through days of game time in
+    seconds.
+    """
+    
+    def __init__(self, start=None, speed=1, origin=None):
+        if origin is None:
+            origin = datetime.datetime.now()
+        self.origin = origin
+        if start is None:
+            start = self.origin
+        self.start = start
+        self.speed = speed
+        self.offset = datetime.timedelta(0)
+    
+    def now(self):
+        elapsed = datetime.datetime.now() - self.origin
+        microseconds = (elapsed.days * 86400 + elapsed.seconds) * 1000000 + elapsed.microseconds
+        return self.start + self.offset + datetime.timedelta(microseconds=int(microseconds * self.speed))
+    
+    def seconds(self, delta):
+        if not self.speed:
+            # stopped; nothing becomes due until the clock is advanced
+            return None
+        return super(SimulatedClock, self).seconds(delta)
+    
+    def advance(self, **kwargs):
+        """
+        Fast-forwards the clock by a timedelta's worth (days=, hours=, ...).
+        """
+        self.offset += datetime.timedelta(**kwargs)
+
+
+def configured_clock():
+    """
+    The clock GAME_CLOCK_SPEED and GAME_CLOCK_EPOCH call for. A fast clock
+    counts from the fixed epoch so every process (and every restart) tells
+    the same game time.
+    """
+    speed = settings.GAME_CLOCK_SPEED
+    if not speed > 0:
+        raise ImproperlyConfigured("GAME_CLOCK_SPEED must be greater than 0, not %r" % speed)
+    if speed == 1:
+        return Clock()
+    epoch = settings.GAME_CLOCK_EPOCH
+    if epoch is None:
+        raise ImproperlyConfigured("GAME_CLOCK_EPOCH must be set when GAME_CLOCK_SPEED is not 1")
+    return SimulatedClock(epoch, speed=speed, origin=epoch)
+
+
+_clock = configured_clock()
+
+_local = threading.local()
+
+
+def get_clock():
+    return _clock
+
+
+def set_clock(clock):
+    """
+    Makes clock the one game time is told by, returning the one it
+    replaces.
+    """
+    global _clock
+    previous, _clock = _clock, clock
+    return previous
+
+
+def now():
+    """
+    The current game time. Within a request it is the instant the request
+    started, so everything the request does sees the same now. Code that
+    runs on well past that (streams, the scheduler) asks the clock itself.
+    """
+    instant = getattr(_local, "instant", None)
+    if instant is not None:
+        return instant
+    return _clock.now()
+
+
+def start(sender, **kwargs):
+    _local.instant = _clock.now()
+
+
+def finish(sender, **kwargs):
+    _local.instant = None
+
+
+request_started.connect(start)
+request_finished.connect(finish)
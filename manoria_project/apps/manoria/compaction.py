@@ -0,0 +1,113 @@
+import itertools
+
+from django.db import transaction
+
+from manoria import clock
+from manoria.models import PlayerResourceCount, SettlementResourceCount, SettlementTerrainResourceCount
+from manoria.timeline import TimelineEntry
+from manoria.utils import bulk_delete, bulk_insert
+
+
+COMPACTED_MODELS = [
+    PlayerResourceCount,
+    SettlementResourceCount,
+    SettlementTerrainResourceCount,
+]
+
+
+def chunked(seq, size):
+    for i in xrange(0, len(seq), size):
+        yield seq[i:i+size]
+
+
+def fold(rows):
+    """
+    Given (id, owner, kind, timestamp, count, natural_rate, rate_adjustment,
+    limit) tuples of the rows before the cutoff ordered by owner, kind,
+    timestamp and id, yields (owner, kind, ids, checkpoint) for every
+    (owner, kind) with history to fold: the ids of the rows to drop and the
+    field values of the checkpoint row to write in their place (None if
+    there is nothing to replace them with).
+    
+    The last row of each (owner, kind) is the current one and is kept, so
+    amount() and current() are identical at every instant from it onwards.
+    Rows sharing its timestamp are never current and are simply dropped.
+    Two or more rows before it are replaced by one checkpoint which starts
+    where they started and holds, without growing, the amount they had
+    reached when the current row took over. Instants before the current row
+    therefore still resolve to a row, but to that amount rather than the
+    one they had at the time.
+    """
+    for (owner, kind), group in itertools.groupby(rows, key=lambda row: row[1:3]):
+        group = list(group)
+        current = group[-1]
+        older = [row for row in group[:-1] if row[3] < current[3]]
+        ids = [row[0] for row in group[:-1] if row[3] == current[3]]
+        checkpoint = None
+        if len(older) > 1:
+            last = TimelineEntry(older[-1][0], *older[-1][3:])
+            checkpoint = {
+                "timestamp": older[0][3],
+                "count": last.amount(current[3]),
+                "natural_rate": 0,
+                "rate_adjustment": 0,
+                "limit": last.limit,
+            }
+            ids.extend([row[0] for row in older])
+        if ids:
+            yield owner, kind, ids, checkpoint
+
+
+def compact(ResourceCount, when=None, batch_size=500, dry_run=False):
+    """
+    Folds the history of ResourceCount older than each (owner, kind)'s
+    current row at the given time (or now) into a single checkpoint row
+    (see fold).
+    
+    Owners are walked in primary key order batch_size at a time and each
+    batch is committed on its own, so this can run against a live database:
+    rows written by queue() after the cutoff are never touched. Returns the
+    number of rows removed, net of the checkpoints written (or the number
+    that would be when dry_run is set).
+    """
+    if when is None:
+        when = clock.now()
+    owner_field = ResourceCount.owner_field
+    Owner = ResourceCount._meta.get_field(owner_field).rel.to
+    removed = 0
+    last_pk = 0
+    while True:
+        owner_ids = list(
+            Owner._default_manager.filter(pk__gt=last_pk).order_by("pk").values_list("pk", flat=True)[:batch_size]
+        )
+        if not owner_ids:
+            break
+        last_pk = owner_ids[-1]
+        removed += _compact_batch(ResourceCount, owner_ids, when, batch_size, dry_run)
+    return removed
+
+
+@transaction.commit_on_success
+def _compact_batch(ResourceCount, owner_ids, when, batch_size, dry_run):
+    owner_field = ResourceCount.owner_field
+    lookup_params = {
+        "%s__in" % owner_field: owner_ids,
+        "timestamp__lt": when,
+    }
+    rows = ResourceCount._default_manager.filter(**lookup_params)
+    rows = rows.order_by(owner_field, "kind", "timestamp", "id")
+    rows = rows.values_list(
+        "id", owner_field, "kind", "timestamp", "count", "natural_rate", "rate_adjustment", "limit"
+    ).iterator()
+    ids, checkpoints = [], []
+    for owner, kind, dropped, checkpoint in fold(rows):
+        ids.extend(dropped)
+        if checkpoint is not None:
+            checkpoint["%s_id" % owner_field] = owner
+            checkpoint["kind_id"] = kind
+            checkpoints.append(ResourceCount(**checkpoint))
+    if not dry_run:
+        bulk_insert(ResourceCount, checkpoints)
+        for chunk in chunked(ids, batch_size):
+            bulk_delete(ResourceCount, chunk)
+    return len(ids) - len(checkpoints)
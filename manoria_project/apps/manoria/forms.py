@@ -1,7 +1,8 @@
 from django import forms
-from django.conf import settings
 
-from manoria.models import Player, Settlement, SettlementBuilding, SettlementTerrain
+from manoria.adjacency import SettlementGrid
+from manoria.catalog import get_catalog
+from manoria.models import Player, Settlement, SettlementBuilding
 
 
 class PlayerCreateForm(forms.ModelForm):
@@ -33,23 +34,29 @@ class BuildingCreateForm(forms.ModelForm):
         self.settlement = settlement
         super(BuildingCreateForm, self).__init__(*args, **kwargs)
     
+    @property
+    def grid(self):
+        """
+        The settlement's terrain and buildings, loaded on first use and
+        meant to be handed on to SettlementBuilding.queue.
+        """
+        if not hasattr(self, "_grid"):
+            self._grid = SettlementGrid.load(self.settlement)
+        return self._grid
+    
     def clean(self):
-        SX, SY = settings.SETTLEMENT_SIZE
-        
         x = self.cleaned_data.get("x")
         y = self.cleaned_data.get("y")
         
         if all([x, y]):
-            if not 1 <= x <= SX or not 1 <= y <= SY:
+            if not self.grid.contains(x, y):
                 raise forms.ValidationError("Building is not within map range")
             
-            if SettlementBuilding.objects.filter(settlement=self.settlement, x=x, y=y).exists():
+            if self.grid.building_at(x, y) is not None:
                 raise forms.ValidationError("A building exists at this location")
             
-            non_buildable_terrain = SettlementTerrain.objects.filter(
-                settlement=self.settlement, x=x, y=y, kind__buildable_on=False
-            )
-            if non_buildable_terrain.exists():
+            terrain = self.grid.terrain_at(x, y)
+            if terrain is not None and not get_catalog().terrain_kinds[terrain.kind_id].buildable_on:
                 raise forms.ValidationError("Building cannot be placed on non-buildable terrain")
         
         return self.cleaned_data
@@ -58,10 +65,10 @@ class BuildingCreateForm(forms.ModelForm):
         building_kind = self.cleaned_data["kind"]
         resource_counts = {}
         for resource_count in self.settlement.resource_counts():
-            resource_counts[resource_count.kind] = resource_count
+            resource_counts[resource_count.kind_id] = resource_count
         failed = []
-        for cost in building_kind.buildingcost_set.all():
-            if resource_counts[cost.resource_kind].amount() < cost.amount:
+        for cost in get_catalog().building_kinds[building_kind.pk].costs:
+            if resource_counts[cost.resource_kind.pk].amount() < cost.amount:
                 failed.append(cost.resource_kind)
         if failed:
             raise forms.ValidationError("Insufficient resources: %s" % ", ".join([k.name for k in failed]))
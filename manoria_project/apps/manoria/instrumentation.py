@@ -0,0 +1,194 @@
+import math
+import threading
+import time
+
+from collections import deque
+
+from django.db.backends import BaseDatabaseWrapper
+from django.template import Template
+
+
+# how many of the most recent requests of each view the percentiles are
+# taken over
+STATS_SAMPLES = 1000
+
+PERCENTILES = [50, 95, 99]
+
+METRICS = ["queries", "sql_ms", "template_ms", "total_ms"]
+
+
+_local = threading.local()
+
+
+class Recorder(object):
+    """
+    Tallies the queries, SQL time and template time of the request being
+    handled by the current thread. Template time is that of the outermost
+    template rendered (includes and other templates rendered from it are
+    part of it) and includes any queries it caused.
+    """
+    
+    def __init__(self):
+        self.started = time.time()
+        self.queries = 0
+        self.sql_time = 0.0
+        self.template_time = 0.0
+        self.rendering = False
+    
+    def sample(self):
+        return {
+            "queries": self.queries,
+            "sql_ms": 1000 * self.sql_time,
+            "template_ms": 1000 * self.template_time,
+            "total_ms": 1000 * (time.time() - self.started),
+        }
+
+
+def start():
+    _local.recorder = Recorder()
+    return _local.recorder
+
+
+def stop():
+    recorder = current()
+    _local.recorder = None
+    return recorder
+
+
+def current():
+    return getattr(_local, "recorder", None)
+
+
+class TimedCursor(object):
+    """
+    Wraps a database cursor to count and time the queries it runs into a
+    recorder.
+    """
+    
+    def __init__(self, cursor, recorder):
+        self.cursor = cursor
+        self.recorder = recorder
+    
+    def _timed(self, method, args):
+        start = time.time()
+        try:
+            return method(*args)
+        finally:
+            self.recorder.queries += 1
+            self.recorder.sql_time += time.time() - start
+    
+    def execute(self, *args):
+        return self._timed(self.cursor.execute, args)
+    
+    def executemany(self, *args):
+        return self._timed(self.cursor.executemany, args)
+    
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+    
+    def __iter__(self):
+        return iter(self.cursor)
+
+
+def install():
+    """
+    Hooks the recorder into cursors and template rendering (once per
+    process). Threads not recording a request are left alone. Counts queries
+    whether or not DEBUG is on, unlike connection.queries.
+    """
+    if getattr(BaseDatabaseWrapper.cursor, "instrumented", False):
+        return
+    
+    original_cursor = BaseDatabaseWrapper.cursor
+    original_render = Template.render
+    
+    def cursor(self):
+        cursor = original_cursor(self)
+        recorder = current()
+        if recorder is not None:
+            cursor = TimedCursor(cursor, recorder)
+        return cursor
+    
+    def render(self, context):
+        recorder = current()
+        if recorder is None or recorder.rendering:
+            return original_render(self, context)
+        recorder.rendering = True
+        start = time.time()
+        try:
+            return original_render(self, context)
+        finally:
+            recorder.rendering = False
+            recorder.template_time += time.time() - start
+    
+    cursor.instrumented = True
+    BaseDatabaseWrapper.cursor = cursor
+    Template.render = render
+
+
+def percentile(values, p):
+    """
+    The nearest-rank percentile of sorted values.
+    """
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+
+class ViewStats(object):
+    """
+    The recent samples of every view, kept in rolling windows of the last
+    so many requests from which percentiles are worked out on demand.
+    """
+    
+    def __init__(self, samples=STATS_SAMPLES):
+        self.samples = samples
+        self._lock = threading.Lock()
+        self._windows = {}
+        self._requests = {}
+    
+    def record(self, view, sample):
+        self._lock.acquire()
+        try:
+            windows = self._windows.get(view)
+            if windows is None:
+                windows = self._windows[view] = dict([
+                    (metric, deque(maxlen=self.samples)) for metric in METRICS
+                ])
+            for metric in METRICS:
+                windows[metric].append(sample[metric])
+            self._requests[view] = self._requests.get(view, 0) + 1
+        finally:
+            self._lock.release()
+    
+    def summary(self):
+        """
+        Returns {view: {"requests": total, metric: {"p50": ..., ...}}} for
+        every view recorded so far.
+        """
+        self._lock.acquire()
+        try:
+            windows = dict([
+                (view, dict([(metric, sorted(values)) for metric, values in metrics.iteritems()]))
+                for view, metrics in self._windows.iteritems()
+            ])
+            requests = dict(self._requests)
+        finally:
+            self._lock.release()
+        summary = {}
+        for view, metrics in windows.iteritems():
+            summary[view] = {"requests": requests[view]}
+            for metric, values in metrics.iteritems():
+                summary[view][metric] = dict([
+                    ("p%d" % p, percentile(values, p)) for p in PERCENTILES
+                ])
+        return summary
+    
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._windows.clear()
+            self._requests.clear()
+        finally:
+            self._lock.release()
+
+
+stats = ViewStats()
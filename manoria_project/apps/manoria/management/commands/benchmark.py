@@ -0,0 +1,140 @@
+import datetime
+import os
+import subprocess
+import sys
+
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import CommandError, NoArgsCommand
+from django.db import connection
+from django.utils import simplejson as json
+
+from manoria.benchmarks import World
+from manoria.benchmarks.cases import BENCHMARKS
+from manoria.catalog import invalidate as invalidate_catalog
+
+
+def revision():
+    """
+    The git commit the code is at (None if it cannot be told).
+    """
+    try:
+        process = subprocess.Popen(["git", "rev-parse", "HEAD"],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=os.path.dirname(__file__)
+        )
+    except OSError:
+        return None
+    out, _ = process.communicate()
+    if process.returncode:
+        return None
+    return out.strip()
+
+
+class Command(NoArgsCommand):
+    help = "Measures the wall time, queries and peak memory of the game's hot paths in scratch worlds of several sizes."
+    
+    option_list = NoArgsCommand.option_list + (
+        make_option("--sizes", action="store", dest="sizes", default="10,100",
+            help="Comma separated numbers of players of the worlds to measure in."
+        ),
+        make_option("--repeat", action="store", dest="repeat", type="int", default=10,
+            help="Number of calls to measure of each benchmark."
+        ),
+        make_option("--seed", action="store", dest="seed", type="int", default=0,
+            help="Seed the worlds are generated with."
+        ),
+        make_option("--only", action="store", dest="only", default=None,
+            help="Comma separated names of the benchmarks to run (all by default)."
+        ),
+        make_option("--output", action="store", dest="output", default=None,
+            help="File to write the results to as JSON (- for standard output)."
+        ),
+        make_option("--compare", action="store", dest="compare", default=None,
+            help="JSON results (from --output) to compare these with."
+        ),
+    )
+    
+    def handle_noargs(self, **options):
+        if not connection.settings_dict["ENGINE"].endswith("sqlite3"):
+            raise CommandError("benchmarks are only comparable with each other on SQLite")
+        sizes = [int(size) for size in options["sizes"].split(",")]
+        benchmarks = BENCHMARKS
+        if options["only"]:
+            names = options["only"].split(",")
+            benchmarks = [benchmark for benchmark in BENCHMARKS if benchmark.name in names]
+            if len(benchmarks) != len(names):
+                raise CommandError("unknown benchmark; pick from %s" % ", ".join([b.name for b in BENCHMARKS]))
+        
+        results = []
+        for size in sizes:
+            results.extend(self.run(size, benchmarks, options["repeat"], options["seed"]))
+        
+        document = {
+            "revision": revision(),
+            "created": datetime.datetime.now().isoformat(),
+            "seed": options["seed"],
+            "results": results,
+        }
+        if options["output"] == "-":
+            sys.stdout.write(json.dumps(document, indent=2) + "\n")
+        else:
+            if options["output"]:
+                out = open(options["output"], "w")
+                try:
+                    json.dump(document, out, indent=2)
+                finally:
+                    out.close()
+            self.report(results)
+        if options["compare"]:
+            self.compare(results, json.load(open(options["compare"])))
+        
+        over = [
+            result for result in results
+            if result["query_limit"] is not None and result["queries"]["max"] > result["query_limit"]
+        ]
+        if over:
+            raise CommandError("; ".join([
+                "%s issued %d queries (limit %d)" % (result["benchmark"], result["queries"]["max"], result["query_limit"])
+                for result in over
+            ]))
+    
+    def run(self, size, benchmarks, repeat, seed):
+        old_name = settings.DATABASES["default"]["NAME"]
+        connection.creation.create_test_db(verbosity=0)
+        # loaded from the real database, if at all
+        invalidate_catalog()
+        debug, settings.DEBUG = settings.DEBUG, True
+        try:
+            world = World(size, seed)
+            return [benchmark(world).run(repeat) for benchmark in benchmarks]
+        finally:
+            settings.DEBUG = debug
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            invalidate_catalog()
+    
+    def report(self, results):
+        sys.stdout.write("%6s  %-40s %10s %10s %8s %10s\n" % ("size", "benchmark", "mean ms", "max ms", "queries", "memory kb"))
+        for result in results:
+            sys.stdout.write("%6d  %-40s %10.1f %10.1f %8d %10s\n" % (
+                result["size"],
+                result["benchmark"],
+                result["time_ms"]["mean"],
+                result["time_ms"]["max"],
+                result["queries"]["max"],
+                result["peak_memory_growth_kb"],
+            ))
+    
+    def compare(self, results, baseline):
+        sys.stdout.write("compared with %s:\n" % (baseline.get("revision") or "baseline"))
+        before = dict([((r["size"], r["benchmark"]), r) for r in baseline["results"]])
+        for result in results:
+            old = before.get((result["size"], result["benchmark"]))
+            if old is None:
+                continue
+            sys.stdout.write("%6d  %-40s %+9.0f%% %+8d queries\n" % (
+                result["size"],
+                result["benchmark"],
+                100 * (result["time_ms"]["mean"] / old["time_ms"]["mean"] - 1),
+                result["queries"]["max"] - old["queries"]["max"],
+            ))
@@ -0,0 +1,29 @@
+import sys
+
+from django.core.management.base import CommandError, NoArgsCommand
+from django.db import connection
+
+from manoria.queryplans import hot_queries, plan_problems, query_plan
+
+
+class Command(NoArgsCommand):
+    help = "Fails if any hot query falls back to a full table scan or a sort (SQLite only)."
+    
+    def handle_noargs(self, **options):
+        verbosity = int(options.get("verbosity", 1))
+        if not connection.settings_dict["ENGINE"].endswith("sqlite3"):
+            raise CommandError("query plans can only be checked on SQLite")
+        failures = []
+        for name, queryset in hot_queries():
+            plan = query_plan(queryset)
+            problems = plan_problems(plan)
+            if problems:
+                failures.append(name)
+            if verbosity > 1 or (problems and verbosity):
+                sys.stdout.write("%s%s\n" % (name, " (FULL SCAN OR SORT)" if problems else ""))
+                for line in plan:
+                    sys.stdout.write("    %s\n" % line)
+        if failures:
+            raise CommandError("full table scans or sorts in: %s" % ", ".join(failures))
+        if verbosity:
+            sys.stdout.write("all hot queries use an index\n")
@@ -0,0 +1,34 @@
+import sys
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from manoria.compaction import COMPACTED_MODELS, compact
+
+
+class Command(NoArgsCommand):
+    help = "Folds resource count history older than each current row into a checkpoint row."
+    
+    option_list = NoArgsCommand.option_list + (
+        make_option("--batch-size", action="store", dest="batch_size", type="int", default=500,
+            help="Number of owners compacted per transaction."
+        ),
+        make_option("--dry-run", action="store_true", dest="dry_run", default=False,
+            help="Only report how many rows would be removed."
+        ),
+    )
+    
+    def handle_noargs(self, **options):
+        verbosity = int(options.get("verbosity", 1))
+        for ResourceCount in COMPACTED_MODELS:
+            removed = compact(ResourceCount,
+                batch_size=options["batch_size"],
+                dry_run=options["dry_run"],
+            )
+            if verbosity:
+                sys.stdout.write("%s: %d rows %s\n" % (
+                    ResourceCount.__name__,
+                    removed,
+                    "would be removed" if options["dry_run"] else "removed",
+                ))
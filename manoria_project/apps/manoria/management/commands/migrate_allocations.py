@@ -0,0 +1,59 @@
+import sys
+
+from django.core.management.base import CommandError, NoArgsCommand
+from django.db import connection, transaction
+
+from manoria.models import Continent, Settlement
+from manoria.occupancy import Occupancy
+
+
+# turns the old text column into a binary one; SQLite keeps whatever type
+# of value it is given so needs nothing
+ALTER_COLUMN = {
+    "postgresql": "ALTER TABLE %(table)s ALTER COLUMN %(column)s TYPE bytea USING ''::bytea",
+    "postgresql_psycopg2": "ALTER TABLE %(table)s ALTER COLUMN %(column)s TYPE bytea USING ''::bytea",
+    "mysql": "ALTER TABLE %(table)s MODIFY %(column)s longblob NOT NULL",
+}
+
+
+class Command(NoArgsCommand):
+    help = "Converts continent and settlement allocations from the old \"x,y\" text (or bitmaps stored without their size) to occupancy bitmaps."
+    
+    @transaction.commit_on_success
+    def handle_noargs(self, **options):
+        verbosity = int(options.get("verbosity", 1))
+        engine = connection.settings_dict["ENGINE"].split(".")[-1]
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        for model in [Continent, Settlement]:
+            field = model._meta.get_field("allocation")
+            params = {
+                "table": qn(model._meta.db_table),
+                "column": qn(field.column),
+                "pk": qn(model._meta.pk.column),
+            }
+            cursor.execute("SELECT %(pk)s, %(column)s FROM %(table)s" % params)
+            # text columns come back as unicode, binary ones never do; bits
+            # stored without the size of the map are given one
+            legacy = []
+            text = False
+            for pk, value in cursor.fetchall():
+                if isinstance(value, unicode):
+                    legacy.append((pk, Occupancy.from_text(field.size, value)))
+                    text = True
+                elif not Occupancy.has_header(value):
+                    legacy.append((pk, Occupancy(field.size, value)))
+            if not legacy:
+                if verbosity:
+                    sys.stdout.write("%s allocations are up to date\n" % model._meta.verbose_name)
+                continue
+            if text and engine != "sqlite3":
+                if engine not in ALTER_COLUMN:
+                    raise CommandError("Don't know how to alter %s columns on %s" % (params["column"], engine))
+                cursor.execute(ALTER_COLUMN[engine] % params)
+            cursor.executemany("UPDATE %(table)s SET %(column)s = %%s WHERE %(pk)s = %%s" % params, [
+                (field.get_db_prep_save(occupancy, connection=connection), pk)
+                for pk, occupancy in legacy
+            ])
+            if verbosity:
+                sys.stdout.write("%d %s allocations converted\n" % (len(legacy), model._meta.verbose_name))
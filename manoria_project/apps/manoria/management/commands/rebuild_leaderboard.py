@@ -0,0 +1,17 @@
+import sys
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from manoria.models import LeaderboardEntry
+
+
+class Command(NoArgsCommand):
+    help = "Rebuilds the materialized leaderboard from resource counts and buildings."
+    
+    @transaction.commit_on_success
+    def handle_noargs(self, **options):
+        verbosity = int(options.get("verbosity", 1))
+        rebuilt = LeaderboardEntry.rebuild()
+        if verbosity:
+            sys.stdout.write("%d leaderboard entries rebuilt\n" % rebuilt)
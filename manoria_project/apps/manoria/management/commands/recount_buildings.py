@@ -0,0 +1,39 @@
+import sys
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from django.db.models import Count, Min
+
+from manoria import clock
+from manoria.models import LeaderboardEntry, Settlement, SettlementBuilding
+
+
+class Command(NoArgsCommand):
+    help = "Recounts the queued and completed buildings of every settlement."
+    
+    @transaction.commit_on_success
+    def handle_noargs(self, **options):
+        verbosity = int(options.get("verbosity", 1))
+        now = clock.now()
+        buildings = SettlementBuilding.objects.values("settlement")
+        totals = dict(buildings.annotate(total=Count("pk")).values_list("settlement", "total"))
+        queued = dict([
+            (row["settlement"], row)
+            for row in buildings.filter(construction_end__gt=now).annotate(
+                queued=Count("pk"), next_completion=Min("construction_end")
+            )
+        ])
+        settlements = Settlement.objects.select_related("player")
+        for settlement in settlements:
+            row = queued.get(settlement.pk, {"queued": 0, "next_completion": None})
+            settlement.building_count = totals.get(settlement.pk, 0)
+            settlement.completed_building_count = settlement.building_count - row["queued"]
+            settlement.next_completion = row["next_completion"]
+            Settlement.objects.filter(pk=settlement.pk).update(
+                building_count=settlement.building_count,
+                completed_building_count=settlement.completed_building_count,
+                next_completion=settlement.next_completion,
+            )
+            LeaderboardEntry.update_buildings(settlement)
+        if verbosity:
+            sys.stdout.write("%d settlements recounted\n" % len(settlements))
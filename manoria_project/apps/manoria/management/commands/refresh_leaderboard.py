@@ -0,0 +1,16 @@
+import sys
+
+from django.core.management.base import NoArgsCommand
+
+from manoria import clock
+from manoria.models import LeaderboardEntry
+
+
+class Command(NoArgsCommand):
+    help = "Brings the values the leaderboard ranks on up to date (the scheduler does so every minute)."
+    
+    def handle_noargs(self, **options):
+        verbosity = int(options.get("verbosity", 1))
+        refreshed = LeaderboardEntry.refresh(clock.now())
+        if verbosity:
+            sys.stdout.write("%d leaderboard entries refreshed\n" % refreshed)
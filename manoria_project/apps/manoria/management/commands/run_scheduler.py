@@ -0,0 +1,39 @@
+import sys
+import time
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from manoria.worker import POLL_INTERVAL, Worker
+
+
+class Command(NoArgsCommand):
+    help = "Runs the worker which refreshes settlements as their buildings finish and resource counts change."
+    
+    option_list = NoArgsCommand.option_list + (
+        make_option("--poll", action="store", dest="poll", type="float", default=POLL_INTERVAL,
+            help="Seconds between looks for settlements that have changed."
+        ),
+    )
+    
+    def handle_noargs(self, **options):
+        verbosity = int(options.get("verbosity", 1))
+        worker = Worker(poll=options["poll"])
+        worker.load()
+        if verbosity:
+            sys.stdout.write("scheduler running; ctrl-c to stop\n")
+        try:
+            while True:
+                refreshed = self.step(worker)
+                if refreshed and verbosity > 1:
+                    sys.stdout.write("%d settlements refreshed\n" % refreshed)
+                time.sleep(worker.delay())
+        except KeyboardInterrupt:
+            pass
+    
+    @transaction.commit_on_success
+    def step(self, worker):
+        # one transaction per step so refreshes are seen straight away
+        return worker.step()
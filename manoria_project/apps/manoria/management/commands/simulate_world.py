@@ -0,0 +1,178 @@
+import random
+import sys
+import time
+
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import CommandError, NoArgsCommand
+from django.db import reset_queries, transaction
+
+from django.contrib.auth.models import User
+
+from manoria import clock
+from manoria.adjacency import SettlementGrid
+from manoria.catalog import get_catalog
+from manoria.models import Continent, ContinentFull, LeaderboardEntry, Player, PlayerResourceCount, Settlement
+from manoria.models import SettlementBuilding, SettlementResourceCount
+from manoria.timeline import TimelineCache
+from manoria.utils import bulk_insert
+
+
+class Command(NoArgsCommand):
+    help = "Populates the database with simulated players, settlements and building orders."
+    
+    option_list = NoArgsCommand.option_list + (
+        make_option("--players", action="store", dest="players", type="int", default=100,
+            help="Number of players to create, each with one settlement."
+        ),
+        make_option("--orders", action="store", dest="orders", type="int", default=10,
+            help="Number of building orders each settlement places."
+        ),
+        make_option("--interval", action="store", dest="interval", type="int", default=600,
+            help="Simulated seconds between building orders."
+        ),
+        make_option("--seed", action="store", dest="seed", type="int", default=0,
+            help="Seed for everything random, so a world can be generated again."
+        ),
+        make_option("--prefix", action="store", dest="prefix", default="sim",
+            help="Prefix of the generated user, player and settlement names."
+        ),
+    )
+    
+    def handle_noargs(self, **options):
+        verbosity = int(options.get("verbosity", 1))
+        prefix = options["prefix"]
+        if Player.objects.filter(name__startswith=prefix).exists():
+            raise CommandError("players named %s... already exist; pick another --prefix" % prefix)
+        
+        # place() and allocate_cell() draw from the module random too
+        random.seed(options["seed"])
+        start = clock.now()
+        
+        started = time.time()
+        players = self.create_players(prefix, options["players"], start)
+        if verbosity:
+            sys.stdout.write("%d players created in %.1fs\n" % (len(players), time.time() - started))
+        
+        started = time.time()
+        continents = list(Continent.objects.order_by("pk"))
+        orders = 0
+        real_clock = clock.get_clock()
+        try:
+            for i, player in enumerate(players):
+                # every settlement starts out at the same (stopped) time
+                game_clock = clock.SimulatedClock(start, speed=0)
+                clock.set_clock(game_clock)
+                orders += self.simulate_settlement(prefix, i, player, continents, options, game_clock)
+                if settings.DEBUG:
+                    reset_queries()
+                if verbosity > 1 and (i + 1) % 100 == 0:
+                    sys.stdout.write("%d settlements placed\n" % (i + 1))
+        finally:
+            clock.set_clock(real_clock)
+        if verbosity:
+            sys.stdout.write("%d settlements placed with %d building orders in %.1fs\n" % (
+                len(players), orders, time.time() - started
+            ))
+    
+    def simulate_settlement(self, prefix, i, player, continents, options, game_clock):
+        """
+        Places the player's settlement and has it place its building orders.
+        Returns the number of buildings queued.
+        """
+        settlement = Settlement(name="%s%dville" % (prefix, i), player=player)
+        while True:
+            if not continents:
+                continents.append(Continent.objects.create(name="%s %d" % (prefix, Continent.objects.count() + 1)))
+            settlement.continent = continents[0]
+            try:
+                settlement.place()
+            except ContinentFull:
+                continents.pop(0)
+            else:
+                break
+        return self.queue_buildings(settlement, options["orders"], options["interval"], game_clock)
+    
+    @transaction.commit_on_success
+    def create_players(self, prefix, count, now):
+        """
+        Creates users and players (with their player resource counts and
+        leaderboard entries) in a handful of bulk inserts.
+        """
+        names = ["%s%d" % (prefix, i) for i in range(count)]
+        bulk_insert(User, [User(username=name, password="!", date_joined=now, last_login=now) for name in names])
+        # looked up by prefix; a list of names this long is more than some
+        # databases take as query parameters
+        users = dict(User.objects.filter(username__startswith=prefix).values_list("username", "pk"))
+        bulk_insert(Player, [Player(user_id=users[name], name=name) for name in names])
+        players = dict([(player.name, player) for player in Player.objects.filter(name__startswith=prefix)])
+        resource_counts = [
+            PlayerResourceCount(
+                player=players[name],
+                kind_id=resource_kind.pk,
+                count=0,
+                natural_rate=0,
+                rate_adjustment=0,
+                limit=0,
+                timestamp=now,
+            )
+            for name in names
+            for resource_kind in get_catalog().resource_kind_list(player=True)
+        ]
+        bulk_insert(PlayerResourceCount, resource_counts)
+        # bulk inserts send no post_save, so the leaderboard entries it would
+        # have projected from each resource count are inserted here
+        kinds = get_catalog().resource_kinds
+        entries = []
+        for resource_count in resource_counts:
+            entry = LeaderboardEntry(metric=kinds[resource_count.kind_id].slug, player=resource_count.player)
+            entry.project(resource_count.count, resource_count.rate, resource_count.timestamp,
+                limit=resource_count.limit,
+            )
+            entries.append(entry)
+        bulk_insert(LeaderboardEntry, entries)
+        return [players[name] for name in names]
+    
+    def queue_buildings(self, settlement, orders, interval, game_clock):
+        """
+        Every interval seconds (fast-forwarding the game clock), queues a
+        random building the settlement can afford on a random free buildable
+        cell. Returns the number of buildings queued.
+        """
+        catalog = get_catalog()
+        grid = SettlementGrid.load(settlement)
+        timelines = TimelineCache()
+        SX, SY = grid.size
+        all_cells = [(x, y) for x in range(1, SX + 1) for y in range(1, SY + 1)]
+        queued = 0
+        for n in range(orders):
+            game_clock.advance(seconds=interval)
+            now = game_clock.now()
+            # reloads what the last order wrote to; queue() reuses the rest
+            timelines.prefetch(SettlementResourceCount, [settlement])
+            affordable = [
+                kind for kind in catalog.building_kind_list()
+                if all([
+                    timelines.get(SettlementResourceCount, settlement, cost.resource_kind).amount(now) >= cost.amount
+                    for cost in kind.costs
+                ])
+            ]
+            cells = [cell for cell in all_cells if self.buildable(grid, *cell)]
+            if not affordable or not cells:
+                continue
+            x, y = random.choice(cells)
+            building = SettlementBuilding(settlement=settlement, kind_id=random.choice(affordable).pk, x=x, y=y)
+            building.queue(timelines=timelines, grid=grid)
+            queued += 1
+        return queued
+    
+    def buildable(self, grid, x, y):
+        """
+        Whether a building could go on the cell (what BuildingCreateForm
+        checks).
+        """
+        if grid.building_at(x, y) is not None:
+            return False
+        terrain = grid.terrain_at(x, y)
+        return terrain is None or get_catalog().terrain_kinds[terrain.kind_id].buildable_on
@@ -5,3 +5,22 @@ class KindManager(models.Manager):
     
     def get_by_natural_key(self, slug):
         return self.get(slug=slug)
+
+
+class LeaderboardManager(models.Manager):
+    
+    def ranked(self, metric):
+        """
+        Entries of the metric ordered by value, best first (and the newest
+        of those tied first), straight off the (metric, value) index.
+        """
+        entries = self.filter(metric=metric).select_related("player", "settlement")
+        return entries.order_by("-value", "-id")
+    
+    def rank(self, entry):
+        """
+        One-based position of the entry within its metric; entries of the
+        same value share a rank.
+        """
+        return self.filter(metric=entry.metric, value__gt=entry.value).count() + 1
+
@@ -0,0 +1,50 @@
+import threading
+
+from django.core.signals import request_finished, request_started
+from django.utils.functional import wraps
+
+
+_local = threading.local()
+
+
+def memoized(method):
+    """
+    Caches what a model method derives (resource counts, build queues and
+    the like) for the rest of the request, keyed by model, primary key and
+    method, so every instance of the same row shares it. Outside of a
+    request, or on unsaved instances, the method is simply called.
+    """
+    @wraps(method)
+    def inner(self):
+        store = getattr(_local, "store", None)
+        if store is None or self.pk is None:
+            return method(self)
+        key = (self._meta.db_table, self.pk, method.__name__)
+        try:
+            return store[key]
+        except KeyError:
+            value = store[key] = method(self)
+            return value
+    return inner
+
+
+def invalidate():
+    """
+    Forgets everything memoized in the current request; called by whatever
+    changes derived state (queueing buildings, placing settlements).
+    """
+    store = getattr(_local, "store", None)
+    if store is not None:
+        store.clear()
+
+
+def start(sender, **kwargs):
+    _local.store = {}
+
+
+def finish(sender, **kwargs):
+    _local.store = None
+
+
+request_started.connect(start)
+request_finished.connect(finish)
@@ -0,0 +1,60 @@
+import logging
+import time
+
+from django.conf import settings
+
+from manoria import instrumentation
+
+
+# how often (seconds) the view stats are written to the log
+STATS_LOG_INTERVAL = 300
+
+logger = logging.getLogger("manoria.instrumentation")
+
+
+class InstrumentationMiddleware(object):
+    """
+    Records the queries, SQL time, template time and total time of every
+    request handled by a view in manoria.views into the process-wide view
+    stats (see the instrumentation_stats view) and now and then writes them
+    to the log. With DEBUG on they are also sent as response headers.
+    
+    Best listed first so its time covers the other middleware too.
+    """
+    
+    def __init__(self):
+        instrumentation.install()
+        self.logged = time.time()
+    
+    def process_request(self, request):
+        instrumentation.start()
+    
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if getattr(view_func, "__module__", None) == "manoria.views":
+            request.instrumented_view = view_func.__name__
+    
+    def process_response(self, request, response):
+        recorder = instrumentation.stop()
+        view = getattr(request, "instrumented_view", None)
+        if recorder is None or view is None:
+            return response
+        sample = recorder.sample()
+        instrumentation.stats.record(view, sample)
+        if settings.DEBUG:
+            response["X-Queries"] = str(sample["queries"])
+            response["X-SQL-Time"] = "%.1fms" % sample["sql_ms"]
+            response["X-Template-Time"] = "%.1fms" % sample["template_ms"]
+            response["X-Response-Time"] = "%.1fms" % sample["total_ms"]
+        if time.time() - self.logged >= STATS_LOG_INTERVAL:
+            self.logged = time.time()
+            self.log()
+        return response
+    
+    def log(self):
+        for view, summary in sorted(instrumentation.stats.summary().items()):
+            logger.info("%s: %d requests; %s" % (view, summary["requests"], "; ".join([
+                "%s %s" % (metric, " ".join([
+                    "p%d=%.1f" % (p, summary[metric]["p%d" % p]) for p in instrumentation.PERCENTILES
+                ]))
+                for metric in instrumentation.METRICS
+            ])))
@@ -4,12 +4,19 @@ import itertools
 import random
 
 from django.conf import settings
-from django.db import models, transaction
+from django.db import connection, models, transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
 
 from django.contrib.auth.models import User
 
-from manoria.managers import KindManager
-from manoria.utils import weighted_choices
+from manoria import clock
+from manoria.adjacency import SettlementGrid
+from manoria.catalog import get_catalog, invalidate as invalidate_catalog
+from manoria.managers import KindManager, LeaderboardManager
+from manoria.memo import invalidate as invalidate_memo, memoized
+from manoria.occupancy import Occupancy, OccupancyField
+from manoria.timeline import AmountEvaluator, LinearAmount, ResourceTimeline, TimelineCache, first_change
+from manoria.utils import WeightedSampler, WritePlan, bulk_insert, bulk_update
 
 
 class Player(models.Model):
@@ -25,14 +32,15 @@ class Player(models.Model):
     def __unicode__(self):
         return self.name
     
+    @memoized
     def resource_counts(self):
-        # @@@ instance cache
-        counts = []
-        for row in self.playerresourcecount_set.distinct().values("kind"):
-            kind = ResourceKind.objects.get(id=row["kind"])
-            current = PlayerResourceCount.current(kind, player=self)
-            counts.append(current)
-        return counts
+        counts = PlayerResourceCount.current_many([self])
+        return sorted(counts.values(), key=lambda rc: rc.kind_id)
+
+
+# Settlement.next_change when nothing is scheduled (None means it has not
+# been worked out yet)
+NOTHING_SCHEDULED = datetime.datetime(9999, 12, 31)
 
 
 class Continent(models.Model):
@@ -42,17 +50,96 @@ class Continent(models.Model):
     """
     
     name = models.CharField(max_length=20)
-    allocation = models.TextField()
+    allocation = OccupancyField(size=settings.CONTINENT_SIZE)
+    
+    # number of cells in the free list (None until the list has been built)
+    free_count = models.IntegerField(null=True, editable=False)
+    
+    # bumped whenever the map changes
+    version = models.IntegerField(default=0, editable=False)
     
     def __unicode__(self):
         return self.name
     
+    def touch(self, commit=True):
+        """
+        Bumps the state version so anything cached under the old one (such
+        as the rendered map) is no longer used.
+        """
+        self.version += 1
+        if commit:
+            Continent.objects.filter(pk=self.pk).update(version=models.F("version") + 1)
+    
     @property
     def size(self):
         """
-        The size of the continent (currently stored in settings).
+        The size of the continent (that of its allocation, which is
+        CONTINENT_SIZE as of when the continent was created).
+        """
+        return self.allocation.size
+    
+    def build_free_cells(self):
+        """
+        (Re)builds the free list from the settlements already placed on the
+        continent.
         """
-        return settings.CONTINENT_SIZE
+        occupancy = Occupancy(self.size)
+        for x, y in self.settlement_set.values_list("x", "y"):
+            occupancy.occupy(x, y)
+        free = list(occupancy.free_cells())
+        self.free_cells.all().delete()
+        bulk_insert(ContinentCell, [
+            ContinentCell(continent=self, position=position, x=x, y=y)
+            for position, (x, y) in enumerate(free)
+        ])
+        self.free_count = len(free)
+        Continent.objects.filter(pk=self.pk).update(free_count=self.free_count)
+    
+    def allocate_cell(self):
+        """
+        Picks a free cell uniformly at random, takes it off the free list in
+        constant time by moving the last free cell into its position and
+        marks it taken in the allocation. Raises ContinentFull if there are
+        no free cells left.
+        
+        The cell is claimed with an UPDATE conditional on free_count still
+        being what was read, retried with the count as it is now whenever a
+        concurrent placement got there first. The claim holds the
+        continent's row until the transaction ends (place runs this in one)
+        so the rest of the work is not raced.
+        """
+        while True:
+            if self.free_count is None:
+                self.build_free_cells()
+            if self.free_count == 0:
+                raise ContinentFull("%s is full" % self.name)
+            last = self.free_count - 1
+            claimed = Continent.objects.filter(pk=self.pk, free_count=self.free_count).update(
+                free_count=last,
+                version=models.F("version") + 1,
+            )
+            if claimed:
+                break
+            self.free_count = Continent.objects.filter(pk=self.pk).values_list("free_count", flat=True)[0]
+        position = random.randint(0, last)
+        cell = self.free_cells.get(position=position)
+        x, y = cell.x, cell.y
+        if position == last:
+            cell.delete()
+        else:
+            moved = self.free_cells.get(position=last)
+            cell.x, cell.y = moved.x, moved.y
+            moved.delete()
+            cell.save()
+        # read back what earlier placements wrote rather than overwriting it
+        # with the allocation as it was loaded
+        current = Continent.objects.get(pk=self.pk)
+        current.allocation.occupy(x, y)
+        Continent.objects.filter(pk=self.pk).update(allocation=current.allocation)
+        self.free_count = last
+        self.version = current.version
+        self.allocation = current.allocation
+        return x, y
     
     def cells(self):
         """
@@ -60,10 +147,39 @@ class Continent(models.Model):
         continent. A cell is largely a mapable object (any model with x, y
         fields)
         """
-        for cell in self.settlement_set.all():
+        for cell in self.settlement_set.select_related("player"):
             yield cell
 
 
+class ContinentFull(Exception):
+    """
+    Raised when a settlement cannot be placed because every cell of the
+    continent is taken.
+    """
+    pass
+
+
+class ContinentCell(models.Model):
+    """
+    A free cell on a continent. The free cells of a continent form a dense
+    list (positions 0 to free_count - 1) so a random one can be picked and
+    removed without scanning or retrying.
+    """
+    
+    continent = models.ForeignKey(Continent, related_name="free_cells")
+    position = models.IntegerField()
+    
+    # location on continent
+    x = models.IntegerField()
+    y = models.IntegerField()
+    
+    class Meta:
+        unique_together = [("continent", "position")]
+    
+    def __unicode__(self):
+        return u"%d,%d on %s" % (self.x, self.y, self.continent)
+
+
 class BaseKind(models.Model):
     """
     An abstract base class for kinds of objects.
@@ -108,19 +224,216 @@ class Settlement(models.Model):
     x = models.IntegerField()
     y = models.IntegerField()
     
-    allocation = models.TextField()
+    allocation = OccupancyField(size=settings.SETTLEMENT_SIZE)
+    
+    # bumped whenever the settlement changes, either directly or because a
+    # scheduled change (a resource count or building changing over) is due;
+    # changed is when it was last bumped and next_change when it next will
+    # be (None if that has not been worked out yet, NOTHING_SCHEDULED if it
+    # will not be)
+    version = models.IntegerField(default=0, editable=False)
+    changed = models.DateTimeField(null=True, editable=False)
+    next_change = models.DateTimeField(null=True, editable=False)
+    
+    # buildings queued or built and how many of them are built as of the
+    # last time the queue was rolled over; next_completion is when the next
+    # queued building finishes (None if nothing is queued)
+    building_count = models.IntegerField(default=0, editable=False)
+    completed_building_count = models.IntegerField(default=0, editable=False)
+    next_completion = models.DateTimeField(null=True, editable=False)
     
     # @@@ points
     
     def __unicode__(self):
         return u"%s (%s)" % (self.name, self.player)
     
+    def touch(self, commit=True, when=None):
+        """
+        Bumps the state version so anything cached under the old one (such
+        as the rendered map) is no longer used.
+        """
+        if when is None:
+            when = clock.now()
+        self.version += 1
+        self.changed = when
+        self.next_change = None
+        if commit:
+            self.save()
+    
+    def refresh_state(self, when=None):
+        """
+        Brings the state version up to date with scheduled changes: bumps it
+        when the change it was waiting for is due and works out which one to
+        wait for next. Returns True if anything was saved (False too if
+        the settlement changed since it was loaded, in which case it is read
+        again).
+        
+        Only the scheduler (manoria.worker) calls this: it learns which
+        settlements have changed from their next change being reset, which
+        anything else working that out first would hide from it.
+        """
+        if when is None:
+            when = clock.now()
+        version = self.version
+        dirty = self.roll_over_buildings(when)
+        if self.changed is None:
+            self.touch(commit=False, when=when)
+            dirty = True
+        while True:
+            if self.next_change is None:
+                self.next_change = self.calculate_next_change(self.changed) or NOTHING_SCHEDULED
+                dirty = True
+            if when < self.next_change:
+                break
+            self.touch(commit=False, when=when)
+        if dirty:
+            # only over the version the state was worked out from; if the
+            # settlement changed meanwhile (a building was queued, say) that
+            # change stands and is read back instead
+            saved = Settlement.objects.filter(pk=self.pk, version=version).update(
+                version=self.version,
+                changed=self.changed,
+                next_change=self.next_change,
+                completed_building_count=self.completed_building_count,
+                next_completion=self.next_completion,
+            )
+            if not saved:
+                self.reload_state()
+                return False
+        return dirty
+    
+    def roll_over_buildings(self, when=None):
+        """
+        Moves buildings which have finished by when from queued to
+        completed (in memory only). Returns True if any did.
+        """
+        if when is None:
+            when = clock.now()
+        if self.next_completion is None or when < self.next_completion:
+            return False
+        queued = SettlementBuilding.objects.filter(settlement=self, construction_end__gt=when)
+        ends = list(queued.order_by("construction_end").values_list("construction_end", flat=True))
+        self.completed_building_count = self.building_count - len(ends)
+        self.next_completion = ends[0] if ends else None
+        return True
+    
+    def add_building(self, building, when=None):
+        """
+        Counts a building just queued and bumps the state version. The
+        counts are updated in the database, so concurrent queues are all
+        counted, then read back along with the allocation.
+        """
+        if when is None:
+            when = clock.now()
+        settlements = Settlement.objects.filter(pk=self.pk)
+        settlements.update(
+            building_count=models.F("building_count") + 1,
+            version=models.F("version") + 1,
+            changed=when,
+            next_change=None,
+        )
+        # the building finishes after every other queued one so is only the
+        # next to complete when none is
+        settlements.filter(next_completion__isnull=True).update(next_completion=building.construction_end)
+        self.reload_state()
+    
+    def reload_state(self):
+        """
+        Reads the version, building counts and allocation back from the
+        database.
+        """
+        fields = ["version", "changed", "next_change", "building_count",
+            "completed_building_count", "next_completion", "allocation"]
+        values = Settlement.objects.filter(pk=self.pk).values_list(*fields)[0]
+        for name, value in zip(fields, values):
+            setattr(self, name, self._meta.get_field(name).to_python(value))
+    
+    @property
+    def queued_building_count(self):
+        return self.building_count - self.completed_building_count
+    
+    @property
+    def upcoming_change(self):
+        """
+        When the next scheduled change is due or None if nothing is scheduled
+        (or refresh_state has not worked it out yet).
+        """
+        if self.next_change == NOTHING_SCHEDULED:
+            return None
+        return self.next_change
+    
+    def is_stale(self, when=None):
+        """
+        Whether a scheduled change may have come due since the state was
+        last stored (so it has to be worked out to be known).
+        """
+        if when is None:
+            when = clock.now()
+        return self.next_change is None or when >= self.next_change
+    
+    def scheduled_state(self, when=None, timelines=None, builds=None):
+        """
+        Works out the state as of when from what is stored without saving
+        anything (refresh_state is what saves it). Returns (due, upcoming):
+        the latest scheduled change due by when which has not been stored
+        yet (None if there is none) and when the next one is (None if
+        nothing is scheduled). The version together with due tells one state
+        of the settlement from another.
+        
+        timelines and builds are as calculate_next_change takes them and
+        are only loaded when a scheduled change has come due.
+        """
+        if when is None:
+            when = clock.now()
+        if not self.is_stale(when):
+            return None, self.upcoming_change
+        if timelines is None:
+            timelines = TimelineCache().prefetch(SettlementResourceCount, [self])
+        if builds is None:
+            queue = SettlementBuilding.objects.filter(settlement=self, construction_end__gt=self.changed or when)
+            builds = list(queue.values_list("construction_start", "construction_end"))
+        due, upcoming = None, self.next_change
+        if upcoming is None:
+            upcoming = self.calculate_next_change(self.changed or when, timelines, builds)
+        while upcoming is not None and upcoming <= when:
+            due = upcoming
+            upcoming = self.calculate_next_change(due, timelines, builds)
+        return due, upcoming
+    
+    def calculate_next_change(self, when, timelines=None, builds=None):
+        """
+        The first point after when at which a resource count of the
+        settlement changes rate, runs out or hits its limit, or a building
+        starts or finishes being built (None if nothing is scheduled).
+        
+        The settlement's compiled timelines (keyed as TimelineCache.prefetch
+        returns them) and the (construction_start, construction_end) of its
+        queued buildings are loaded unless given.
+        """
+        if timelines is None:
+            timelines = TimelineCache().prefetch(SettlementResourceCount, [self])
+        if builds is None:
+            queue = SettlementBuilding.objects.filter(settlement=self, construction_end__gt=when)
+            builds = queue.values_list("construction_start", "construction_end")
+        changes = [first_change(timelines.values(), when)]
+        for start, end in builds:
+            changes.extend([start, end])
+        changes = [change for change in changes if change is not None and change > when]
+        if changes:
+            return min(changes)
+        return None
+    
     @property
     def size(self):
-        return settings.SETTLEMENT_SIZE
+        """
+        The size of the settlement (that of its allocation, which is
+        SETTLEMENT_SIZE as of when the settlement was created).
+        """
+        return self.allocation.size
     
     def update_kind(self, commit=True):
-        total = self.build_queue().count() + self.buildings().count()
+        # queued and built
+        total = self.building_count
         if total < 3:
             self.kind = "homestead"
         elif total < 10:
@@ -133,38 +446,36 @@ class Settlement(models.Model):
             self.save()
     
     @transaction.commit_on_success
-    def place(self):
-        """
-        Logic for determining how to place itself on the continent.
-        """
-        CX, CY = settings.CONTINENT_SIZE
-        SX, SY = settings.SETTLEMENT_SIZE
-        # @@@ need to test if continent is full otherwise an infinite loop
-        # will occur
-        y = None
-        while y is None:
-            x = random.randint(1, CX)
-            S = set(range(1, CY+1)) - set([s.y for s in Settlement.objects.filter(x=x)])
-            if S:
-                y = random.choice(list(S))
+    def place(self, now=None):
+        """
+        Logic for determining how to place itself on the continent (as of
+        now if given). Raises ContinentFull if there is no free cell left.
+        """
+        SX, SY = self.size
+        # marks x,y used on the continent; raises ContinentFull (rolling
+        # back) when there is no room left
+        x, y = self.continent.allocate_cell()
         self.x = x
         self.y = y
         self.save()
         
-        # mark x,y used on the continent
-        self.continent.allocation += "%s%d,%d" % (" ", x, y)
-        self.continent.save()
+        if now is None:
+            now = clock.now()
+        catalog = get_catalog()
         
         # create the resource counts which are non-player for the settlement
-        for resource_kind in ResourceKind.objects.filter(player=False):
-            self.settlementresourcecount_set.create(
-                kind=resource_kind,
+        bulk_insert(SettlementResourceCount, [
+            SettlementResourceCount(
+                settlement=self,
+                kind_id=resource_kind.pk,
                 count=1000,
                 natural_rate=0,
                 rate_adjustment=0,
-                timestamp=datetime.datetime.now(),
+                timestamp=now,
                 limit=0,
             )
+            for resource_kind in catalog.resource_kind_list(player=False)
+        ])
         
         # the following code is a fairly trivial clustering algorithm which
         # checks neigbors for similar kinds and weights them in choosing what
@@ -172,18 +483,21 @@ class Settlement(models.Model):
         #
         # it is updating an allocation table which is a denormalized way for
         # easily checking if a cell on the map is taken.
+        #
+        # the whole map is generated in memory (grid maps a cell to its
+        # terrain kind) and written with a few bulk inserts at the end.
         
-        def check_cell(settlement, x, y):
+        terrain_kinds = catalog.terrain_kind_list()
+        grid = {}
+        
+        def check_cell(x, y):
             if not 1 <= x <= SX or not 1 <= y <= SY:
-                terrain = None
-            else:
-                try:
-                    terrain = settlement.terrain.select_related("kind").get(x=x, y=y)
-                except SettlementTerrain.DoesNotExist:
-                    terrain = None
-            return terrain
+                return None
+            return grid.get((x, y))
         
-        allocation = []
+        allocation = Occupancy(self.size)
+        placed = []
+        resource_counts = []
         
         for i in range(settings.SETTLEMENT_RESOURCE_COUNT):
             occupied = True
@@ -191,90 +505,127 @@ class Settlement(models.Model):
                 x = random.randint(1, SX)
                 y = random.randint(1, SY)
                 # check if the randomly chosen x, y is not already occupied
-                if not (x, y) in allocation:
+                if allocation.is_free(x, y):
                     break
-            allocation.append((x, y))
+            allocation.occupy(x, y)
+            placed.append((x, y))
             # check surrounding cells
             neighbors = [
-                check_cell(self, x+1, y),
-                check_cell(self, x-1, y),
-                check_cell(self, x, y+1),
-                check_cell(self, x, y-1),
-                check_cell(self, x+1, y+1),
-                check_cell(self, x-1, y-1),
-                check_cell(self, x+1, y-1),
-                check_cell(self, x-1, y+1),
+                check_cell(x+1, y),
+                check_cell(x-1, y),
+                check_cell(x, y+1),
+                check_cell(x, y-1),
+                check_cell(x+1, y+1),
+                check_cell(x-1, y-1),
+                check_cell(x+1, y-1),
+                check_cell(x-1, y+1),
             ]
             counts = collections.defaultdict(int)
             for neighbor in filter(bool, neighbors):
-                counts[neighbor.kind.slug] += 1
+                counts[neighbor.slug] += 1
             population = []
-            for kind in SettlementTerrainKind.objects.all():
+            for kind in terrain_kinds:
                 population.append((kind, counts.get(kind.slug, 0) + 1))
-            kind = weighted_choices(population, 1)[0]
-            terrain = self.terrain.create(kind=kind, x=x, y=y)
+            kind = WeightedSampler(population).draw()
+            grid[(x, y)] = kind
             # create resource counts for what the terrain kind produces
-            for resource_kind in kind.produces.all():
+            for resource_kind in kind.produces:
                 count = random.randint(1, 50000)
-                terrain.settlementterrainresourcecount_set.create(
-                    kind=resource_kind,
+                resource_counts.append(((x, y), SettlementTerrainResourceCount(
+                    kind_id=resource_kind.pk,
                     count=count,
                     natural_rate=count / 100,
                     rate_adjustment=0,
-                    timestamp=datetime.datetime.now(),
+                    timestamp=now,
                     limit=count
-                )
+                )))
+        
+        bulk_insert(SettlementTerrain, [
+            SettlementTerrain(settlement=self, kind_id=grid[(x, y)].pk, x=x, y=y)
+            for x, y in placed
+        ])
+        terrain_ids = dict(((x, y), pk) for pk, x, y in self.terrain.values_list("pk", "x", "y"))
+        for cell, resource_count in resource_counts:
+            resource_count.terrain_id = terrain_ids[cell]
+        bulk_insert(SettlementTerrainResourceCount, [rc for cell, rc in resource_counts])
         
-        self.allocation = " ".join(("%d,%d" % (x, y) for x, y in allocation))
+        self.allocation = allocation
+        self.touch(commit=False, when=now)
         # for updating the allocation table
         self.save()
+        
+        # ranked on the leaderboard from the start, with no buildings yet
+        LeaderboardEntry.objects.create(metric="buildings", player=self.player, settlement=self)
+        
+        invalidate_memo()
     
+    @memoized
     def cells(self):
         """
-        Method for yielding cells (buildings and terrains) used to render a
+        Method for listing cells (buildings and terrains) used to render a
         map of the continent. A cell is largely a mapable object (any model
         with x, y fields)
         """
-        cells = itertools.chain(
-            self.build_queue(), self.buildings(), self.terrain.all()
-        )
-        for cell in cells:
-            yield cell
+        return list(itertools.chain(
+            self.build_queue(),
+            self.buildings(),
+            self.terrain.select_related("kind"),
+        ))
+    
+    def build_queue_queryset(self):
+        """
+        Buildings which are not yet finished building as of the state the
+        scheduler last stored (those from the next to complete on) in the
+        order they are built.
+        """
+        queue = SettlementBuilding.objects.filter(settlement=self)
+        if self.next_completion is None:
+            return queue.none()
+        queue = queue.filter(construction_end__gte=self.next_completion)
+        # buildings are queued back to back so this is also the order they
+        # started in, and the one the index has them in
+        return queue.order_by("construction_end")
     
+    @memoized
     def build_queue(self):
         """
-        Method for getting buildings which are not yet finished building
-        (those which are construction_end in the future)
+        Method for getting buildings which are not yet finished building, as
+        a list so the request shares one query (see build_queue_queryset).
         """
-        queue = SettlementBuilding.objects.filter(
-            settlement=self,
-            construction_end__gt=datetime.datetime.now()
-        )
-        queue = queue.order_by("construction_start")
+        queue = list(self.build_queue_queryset().select_related("kind"))
+        for building in queue:
+            building.settlement = self
         return queue
     
+    def buildings_queryset(self):
+        """
+        Buildings which have already been built as of the state the scheduler
+        last stored (those which finished before the next to complete).
+        """
+        buildings = SettlementBuilding.objects.filter(settlement=self)
+        if self.next_completion is None:
+            return buildings
+        return buildings.filter(construction_end__lt=self.next_completion)
+    
+    @memoized
     def buildings(self):
         """
-        Method for getting buildings which have already been built (those which
-        have construction_end in the past or equal to now).
+        Method for getting buildings which have already been built, as a list
+        so the request shares one query (see buildings_queryset).
         """
-        return SettlementBuilding.objects.filter(
-            settlement=self,
-            construction_end__lte=datetime.datetime.now()
-        )
+        buildings = list(self.buildings_queryset().select_related("kind"))
+        for building in buildings:
+            building.settlement = self
+        return buildings
     
+    @memoized
     def resource_counts(self):
         """
         Obtains all the resource counts for the unique kinds asociated to a
         settlement.
         """
-        # @@@ instance cache
-        counts = []
-        for row in self.settlementresourcecount_set.distinct().values("kind"):
-            kind = ResourceKind.objects.get(id=row["kind"])
-            current = SettlementResourceCount.current(kind, settlement=self)
-            counts.append(current)
-        return counts
+        counts = SettlementResourceCount.current_many([self])
+        return sorted(counts.values(), key=lambda rc: rc.kind_id)
 
 
 class ResourceKind(BaseKind):
@@ -293,19 +644,7 @@ class ResourceKind(BaseKind):
     player = models.BooleanField()
 
 
-def pairwise(iterable):
-    """
-    pulled from itertools recipes, but modified to return last item and None
-    s -> (s0,s1), (s1,s2), (s2, s3), (s3, None)
-    """
-    a, b = itertools.tee(iterable)
-    next(b, None)
-    for a, b in itertools.izip(a, b):
-        yield a, b
-    yield b, None
-
-
-class BaseResourceCount(models.Model):
+class BaseResourceCount(LinearAmount, models.Model):
     """
     BaseResourceCount represents the fact that at a given time, an object will
     contain a certain amount of a certain resource and that amount is either
@@ -317,11 +656,15 @@ class BaseResourceCount(models.Model):
     """
     
     count = models.IntegerField(default=0)
-    timestamp = models.DateTimeField(default=datetime.datetime.now)
+    timestamp = models.DateTimeField(default=clock.now)
     natural_rate = models.DecimalField(max_digits=7, decimal_places=1)
     rate_adjustment = models.DecimalField(max_digits=7, decimal_places=1)
     limit = models.IntegerField(default=0)
     
+    # name of the foreign key on subclasses pointing at the object which owns
+    # the resource count
+    owner_field = None
+    
     class Meta:
         abstract = True
     
@@ -330,54 +673,82 @@ class BaseResourceCount(models.Model):
         """
         Get the most recent (or based on a given when) what the current
         resource count object is for the resource of the given kind. Also,
-        takes additional resource specific data for lookup.
+        takes additional resource specific data for lookup. A count stamped
+        exactly at when only counts if inclusive is given.
         """
-        when = kwargs.pop("when", datetime.datetime.now())
+        when = kwargs.pop("when", clock.now())
+        inclusive = kwargs.pop("inclusive", False)
         lookup_params = {
-            "kind": kind,
-            "timestamp__lt": when,
+            "kind": getattr(kind, "pk", kind),
+            "timestamp__lte" if inclusive else "timestamp__lt": when,
         }
         lookup_params.update(kwargs)
         past = cls._default_manager.filter(**lookup_params).order_by("-timestamp")
         return past[0]
     
     @classmethod
-    def calculate_extremum(cls, kind, **kwargs):
+    def current_queryset(cls, owners, kinds=None, when=None, inclusive=False):
         """
-        Find the next point in the future where the resources of the given
-        kind with either hit their limit or run out.
+        A queryset of the current resource count for every (owner, kind)
+        pair, resolved by the database in a single query. owners may be a
+        list or a queryset (which is kept as a subquery so it scales to the
+        whole world). Rows tied on timestamp are all included, and rows
+        stamped exactly at when too if inclusive is given.
         """
-        current = cls.current(kind, **kwargs)
-        del kwargs["when"]
+        if when is None:
+            when = clock.now()
+        qn = connection.ops.quote_name
         lookup_params = {
-            "kind": kind,
-            "timestamp__gte": current.timestamp,
+            "%s__in" % cls.owner_field: owners,
+            "timestamp__lte" if inclusive else "timestamp__lt": when,
         }
-        lookup_params.update(kwargs)
-        future_counts = cls._default_manager.filter(**lookup_params).order_by("timestamp")
-        for a, b in pairwise(future_counts):
-            if b is None:
-                start, end = a.timestamp, None
-            else:
-                start, end = a.timestamp, b.timestamp
-            count = a.count
-            rate = a.rate
-            limit = a.limit
-            if a.rate < 0:
-                # when the count will hit zero
-                timestamp = start + datetime.timedelta(hours=(count / -float(rate)))
-                if end is not None and timestamp > end:
-                    continue
-                return timestamp, False
-            elif a.rate > 0:
-                # when the count will hit the limit
-                timestamp = start + datetime.timedelta(hours=((limit - count) / float(rate)))
-                if end is not None and timestamp > end:
-                    continue
-                return timestamp, True
-            else:
-                continue
-        return None, None
+        if kinds is not None:
+            lookup_params["kind__in"] = [getattr(kind, "pk", kind) for kind in kinds]
+        table = qn(cls._meta.db_table)
+        latest = """%(table)s.%(timestamp)s = (
+            SELECT MAX(latest.%(timestamp)s) FROM %(table)s latest
+            WHERE latest.%(owner)s = %(table)s.%(owner)s
+            AND latest.%(kind)s = %(table)s.%(kind)s
+            AND latest.%(timestamp)s %(before)s %%s
+        )""" % {
+            "before": "<=" if inclusive else "<",
+            "table": table,
+            "timestamp": qn(cls._meta.get_field("timestamp").column),
+            "owner": qn(cls._meta.get_field(cls.owner_field).column),
+            "kind": qn(cls._meta.get_field("kind").column),
+        }
+        past = cls._default_manager.filter(**lookup_params)
+        return past.extra(
+            where=[latest], params=[connection.ops.value_to_db_datetime(when)]
+        )
+    
+    @classmethod
+    def current_many(cls, owners, kinds=None, when=None, inclusive=False):
+        """
+        Bulk version of current. Resolves the current resource count for
+        every (owner, kind) pair in a single query no matter how many owners
+        or kinds are asked for. When kinds is None all kinds the owners have
+        counts for are resolved. Returns a dictionary keyed by (owner pk,
+        kind pk).
+        """
+        owner_field = cls.owner_field
+        rows = cls.current_queryset(owners, kinds, when, inclusive)
+        counts = {}
+        # on timestamp ties the row written last wins
+        for rc in rows.select_related("kind").order_by("id"):
+            counts[(getattr(rc, "%s_id" % owner_field), rc.kind_id)] = rc
+        return counts
+    
+    @classmethod
+    def calculate_extremum(cls, kind, **kwargs):
+        """
+        Find the next point in the future where the resources of the given
+        kind with either hit their limit or run out. Solved in closed form
+        from the timeline of the owner and kind, loaded with one query.
+        """
+        when = kwargs.pop("when", None)
+        owner = kwargs.pop(cls.owner_field)
+        return ResourceTimeline.load(cls, owner, kind).next_extremum(when)
     
     @property
     def rate(self):
@@ -385,21 +756,6 @@ class BaseResourceCount(models.Model):
         The current rate of which this count is growing or decreasing
         """
         return self.natural_rate + self.rate_adjustment
-    
-    def amount(self, when=None):
-        """
-        At the given time or now, return the amount of which this resource
-        count is reporting. Normally called after getting the current resource
-        count.
-        """
-        if when is None:
-            when = datetime.datetime.now()
-        change = when - self.timestamp
-        amt = int(self.count + float(self.rate) * (change.days * 86400 + change.seconds) / 3600.0)
-        if self.limit == 0:
-            return max(0, amt)
-        else:
-            return min(max(0, amt), self.limit)
 
 
 class PlayerResourceCount(BaseResourceCount):
@@ -411,6 +767,8 @@ class PlayerResourceCount(BaseResourceCount):
     kind = models.ForeignKey(ResourceKind)
     player = models.ForeignKey(Player)
     
+    owner_field = "player"
+    
     def __unicode__(self):
         return u"%s (%s)" % (self.kind, self.player)
 
@@ -424,6 +782,8 @@ class SettlementResourceCount(BaseResourceCount):
     kind = models.ForeignKey(ResourceKind)
     settlement = models.ForeignKey(Settlement)
     
+    owner_field = "settlement"
+    
     def __unicode__(self):
         return u"%s (%s)" % (self.kind, self.settlement)
 
@@ -499,8 +859,8 @@ class SettlementBuilding(models.Model):
     y = models.IntegerField()
     
     # build queue
-    construction_start = models.DateTimeField(default=datetime.datetime.now)
-    construction_end = models.DateTimeField(default=datetime.datetime.now)
+    construction_start = models.DateTimeField(default=clock.now)
+    construction_end = models.DateTimeField(default=clock.now)
     
     class Meta:
         unique_together = [("settlement", "x", "y")]
@@ -509,13 +869,27 @@ class SettlementBuilding(models.Model):
         return u"%s on %s" % (self.kind, self.settlement)
     
     @transaction.commit_on_success
-    def queue(self):
+    def queue(self, timelines=None, grid=None, now=None):
         """
-        Queues a building to be built.
+        Queues a building to be built (as of now if given, so simulations
+        can run ahead of the clock). Resource counts are read through the
+        given TimelineCache (a fresh one if None) and neighbors are looked up
+        on the given SettlementGrid (loaded when first needed if None) so
+        callers can share both with the rest of the request. Timelines
+        already in the cache are used as they are; those rows are written to
+        are dropped from it afterwards.
         """
+        if timelines is None:
+            timelines = TimelineCache()
+        if now is None:
+            now = clock.now()
+        
+        kind = get_catalog().building_kinds[self.kind_id]
+        
         # look for most recently added building to queue (None if none)
+        queue = SettlementBuilding.objects.filter(settlement=self.settlement, construction_end__gt=now)
         try:
-            oldest = self.settlement.build_queue().reverse()[0]
+            oldest = queue.order_by("-construction_start")[0]
         except IndexError:
             oldest = None
         
@@ -525,86 +899,111 @@ class SettlementBuilding(models.Model):
         if oldest:
             self.construction_start = oldest.construction_end
         else:
-            self.construction_start = datetime.datetime.now()
-        self.construction_end = self.construction_start + datetime.timedelta(seconds=self.kind.build_time)
+            self.construction_start = now
+        self.construction_end = self.construction_start + datetime.timedelta(seconds=kind.build_time)
+        settlement = self.settlement
+        settlement.add_building(self, when=now)
         
         self.save()
+        if grid is not None:
+            grid.add_building(self)
         
-        self.settlement.update_kind(commit=False)
+        # allocate space on the map using settlement allocation table; the
+        # allocation is written back whole so only over the version it was
+        # read at, reading it again if another change got in first
+        while True:
+            settlement.update_kind(commit=False)
+            settlement.allocation.occupy(self.x, self.y)
+            if Settlement.objects.filter(pk=settlement.pk, version=settlement.version).update(
+                kind=settlement.kind,
+                allocation=settlement.allocation,
+            ):
+                break
+            settlement.reload_state()
         
-        # allocate space on the map using settlement allocation table
-        self.settlement.allocation += "%s%d,%d" % (" ", self.x, self.y)
-        self.settlement.save()
+        costs = kind.costs
+        running_costs = kind.running_costs
+        products = kind.products
+        
+        # compile every timeline the plan reads with one query per resource
+        # count model
+        settlement_kinds = [cost.resource_kind for cost in costs]
+        settlement_kinds.extend([running_cost.resource_kind for running_cost in running_costs])
+        settlement_kinds.extend([p.resource_kind for p in products if not p.resource_kind.player])
+        player_kinds = [p.resource_kind for p in products if p.resource_kind.player]
+        if settlement_kinds:
+            timelines.prefetch(SettlementResourceCount, [self.settlement], settlement_kinds)
+        if player_kinds:
+            timelines.prefetch(PlayerResourceCount, [self.settlement.player], player_kinds)
+        
+        # look for terrains which are adjacent and of the correct kind for
+        # each product
+        neighbors = {}
+        for product in products:
+            if product.source_terrain_kind:
+                if grid is None:
+                    grid = SettlementGrid.load(self.settlement)
+                neighbors[product.pk] = grid.neighbors(self.x, self.y, kind=product.source_terrain_kind)
+        terrain = set([neighbor for found in neighbors.values() for neighbor in found])
+        if terrain:
+            timelines.prefetch(SettlementTerrainResourceCount, list(terrain),
+                [p.resource_kind for p in products if neighbors.get(p.pk)]
+            )
+        
+        # plan every row to write, keeping the compiled timelines in step so
+        # each step reads what the ones before it wrote
+        plan = WritePlan()
+        written = set()
+        
+        def write(row):
+            timelines.record(plan.insert(row))
+            key = (getattr(row, "%s_id" % row.owner_field), row.kind_id)
+            written.add((type(row),) + key)
         
         # deduct what the building costs
-        for cost in self.kind.buildingcost_set.all():
-            current = SettlementResourceCount.current(cost.resource_kind, settlement=self.settlement)
-            future = SettlementResourceCount.objects.filter(
-                kind=cost.resource_kind,
-                settlement=self.settlement,
-                timestamp__gt=datetime.datetime.now()
+        for cost in costs:
+            timeline = timelines.get(SettlementResourceCount, self.settlement, cost.resource_kind)
+            plan.increment(SettlementResourceCount,
+                timeline.adjust(timeline.index(now), count=-cost.amount),
+                count=-cost.amount,
             )
-            SettlementResourceCount.objects.filter(
-                id__in=[rc.id for rc in itertools.chain([current], future)]
-            ).update(count=models.F("count") - cost.amount)
         
         # handle the running costs of the building once it is finished
         # being built.
-        for running_cost in self.kind.buildingrunningcost_set.all():
-            current = SettlementResourceCount.current(running_cost.resource_kind,
-                settlement=self.settlement, when=self.construction_end
+        for running_cost in running_costs:
+            timeline = timelines.get(SettlementResourceCount, self.settlement, running_cost.resource_kind)
+            current = timeline.current(self.construction_end)
+            plan.increment(SettlementResourceCount,
+                timeline.adjust(timeline.index_after(self.construction_end), rate_adjustment=-running_cost.rate),
+                rate_adjustment=-running_cost.rate,
             )
-            SettlementResourceCount.objects.create(
-                kind=running_cost.resource_kind,
+            write(SettlementResourceCount(
+                kind_id=running_cost.resource_kind.pk,
                 settlement=self.settlement,
                 timestamp=self.construction_end,
                 natural_rate=current.natural_rate,
                 rate_adjustment=current.rate_adjustment - running_cost.rate,
                 count=current.amount(when=self.construction_end)
-            )
-            future = SettlementResourceCount.objects.filter(
-                kind=running_cost.resource_kind,
-                settlement=self.settlement,
-                timestamp__gt=self.construction_end
-            )
-            SettlementResourceCount.objects.filter(
-                id__in=[rc.id for rc in future]
-            ).update(rate_adjustment=models.F("rate_adjustment") - running_cost.rate)
-        
-        SX, SY = settings.SETTLEMENT_SIZE
-        
-        def check_cell(settlement, x, y, **kwargs):
-            if not 1 <= x <= SX or not 1 <= y <= SY:
-                terrain = None
-            else:
-                try:
-                    terrain = settlement.terrain.filter(**kwargs).select_related("kind")
-                    terrain = terrain.get(x=x, y=y)
-                except SettlementTerrain.DoesNotExist:
-                    terrain = None
-            return terrain
+            ))
         
         # iterate over what the building kind produces setting up the state
         # of resource counts when the building will be finished building
-        for product in self.kind.products.all():
+        for product in products:
             # establish some common params used while creating resource counts
             common_params = {}
             if product.resource_kind.player:
                 ResourceCount = PlayerResourceCount
-                common_params["player"] = self.settlement.player
+                owner = common_params["player"] = self.settlement.player
             else:
                 ResourceCount = SettlementResourceCount
-                common_params["settlement"] = self.settlement
+                owner = common_params["settlement"] = self.settlement
+            timeline = timelines.get(ResourceCount, owner, product.resource_kind)
             
             # adjust the settlement/player resource count based on what the building
             # will produce in the best case scenario.
-            lookup_params = {
-                "when": self.construction_end,
-            }
-            lookup_params.update(common_params)
-            current = ResourceCount.current(product.resource_kind, **lookup_params)
+            current = timeline.current(self.construction_end)
             create_kwargs = {
-                "kind": product.resource_kind,
+                "kind_id": product.resource_kind.pk,
                 "count": current.amount(self.construction_end),
                 "timestamp": self.construction_end,
                 "natural_rate": current.natural_rate,
@@ -612,78 +1011,68 @@ class SettlementBuilding(models.Model):
                 "limit": 0, # @@@ storage
             }
             create_kwargs.update(common_params)
-            ResourceCount.objects.create(**create_kwargs)
+            write(ResourceCount(**create_kwargs))
             
-            if product.source_terrain_kind:
-                
-                # look for terrains which are adjacent and of the correct
-                # kind and adjust rates of each
-                
-                x, y = self.x, self.y
-                
-                neighbors = filter(bool, [
-                    check_cell(self.settlement, x+1, y, kind=product.source_terrain_kind),
-                    check_cell(self.settlement, x-1, y, kind=product.source_terrain_kind),
-                    check_cell(self.settlement, x, y+1, kind=product.source_terrain_kind),
-                    check_cell(self.settlement, x, y-1, kind=product.source_terrain_kind),
-                    check_cell(self.settlement, x+1, y+1, kind=product.source_terrain_kind),
-                    check_cell(self.settlement, x-1, y-1, kind=product.source_terrain_kind),
-                    check_cell(self.settlement, x+1, y-1, kind=product.source_terrain_kind),
-                    check_cell(self.settlement, x-1, y+1, kind=product.source_terrain_kind),
-                ])
+            for neighbor in neighbors.get(product.pk, []):
+                # when the building finishes set what affect it will have on the
+                # terrain resource count
+                terrain_timeline = timelines.get(
+                    SettlementTerrainResourceCount, neighbor, product.resource_kind
+                )
+                current = terrain_timeline.current(self.construction_end)
+                write(SettlementTerrainResourceCount(
+                    kind_id=product.resource_kind.pk,
+                    terrain=neighbor,
+                    count=current.amount(self.construction_end),
+                    timestamp=self.construction_end,
+                    natural_rate=current.natural_rate,
+                    rate_adjustment=current.rate_adjustment - (product.base_rate / len(neighbors[product.pk])),
+                    limit=current.limit,
+                ))
                 
-                for neighbor in neighbors:
-                    # when the building finishes set what affect it will have on the
-                    # terrain resource count
-                    current = SettlementTerrainResourceCount.current(
-                        product.resource_kind,
-                        terrain=neighbor, when=self.construction_end
-                    )
-                    SettlementTerrainResourceCount.objects.create(
-                        kind=product.resource_kind,
-                        terrain=neighbor,
-                        count=current.amount(self.construction_end),
-                        timestamp=self.construction_end,
-                        natural_rate=current.natural_rate,
-                        rate_adjustment=current.rate_adjustment - (product.base_rate / len(neighbors)),
-                        limit=current.limit,
-                    )
-                    
-                    # determine *when* the terrain will either run out or hit its
-                    # limit based on its current rate and if the terrain will hit
-                    # zero by the time the building finishes we need to adjust how
-                    # it affects the settlement resource counts
-                    when, hit_limit = SettlementTerrainResourceCount.calculate_extremum(
-                        product.resource_kind,
-                        terrain=neighbor, when=self.construction_end
-                    )
-                    # if when is None the terrain will never run out or hit a limit
-                    if when and not hit_limit:
-                        lookup_params = {
-                            "when": when,
-                        }
-                        lookup_params.update(common_params)
-                        current = ResourceCount.current(product.resource_kind, **lookup_params)
-                        create_kwargs = {
-                            "kind": product.resource_kind,
-                            "settlement": self.settlement,
-                            "count": current.amount(when),
-                            "timestamp": when,
-                            "natural_rate": current.natural_rate,
-                            "rate_adjustment": current.rate_adjustment - product.base_rate,
-                            "limit": 0, # @@@ storage
-                        }
-                        create_kwargs.update(common_params)
-                        ResourceCount.objects.create(**create_kwargs)
+                # determine *when* the terrain will either run out or hit its
+                # limit based on its current rate and if the terrain will hit
+                # zero by the time the building finishes we need to adjust how
+                # it affects the settlement resource counts
+                when, hit_limit = terrain_timeline.next_extremum(self.construction_end)
+                # if when is None the terrain will never run out or hit a limit
+                if when and not hit_limit:
+                    current = timeline.current(when)
+                    create_kwargs = {
+                        "kind_id": product.resource_kind.pk,
+                        "count": current.amount(when),
+                        "timestamp": when,
+                        "natural_rate": current.natural_rate,
+                        "rate_adjustment": current.rate_adjustment - product.base_rate,
+                        "limit": 0, # @@@ storage
+                    }
+                    create_kwargs.update(common_params)
+                    write(ResourceCount(**create_kwargs))
+        
+        # apply the plan; rows are bulk written so do what the post_save
+        # signals would have done once per timeline rather than per row
+        plan.apply()
+        # the rows just inserted have no primary keys in the compiled
+        # timelines to adjust them by later, so those are compiled afresh
+        for ResourceCount, owner_id, kind_id in written:
+            timelines.invalidate(ResourceCount, owner_id, kind_id)
+        for kind in set(player_kinds):
+            LeaderboardEntry.update_resource(self.settlement.player, kind, when=now)
+        
+        invalidate_memo()
     
     def status(self):
-        now = datetime.datetime.now()
-        if self.construction_start > now:
-            return "queued"
-        elif self.construction_end > now:
+        """
+        Where the building is in the build queue as of the state the
+        scheduler last stored for its settlement.
+        """
+        next_completion = self.settlement.next_completion
+        if next_completion is None or self.construction_end < next_completion:
+            return "built"
+        elif self.construction_start < next_completion:
             return "under construction"
         else:
-            return "built"
+            return "queued"
 
 
 class SettlementBuildingResourceCount(BaseResourceCount):
@@ -694,7 +1083,10 @@ class SettlementBuildingResourceCount(BaseResourceCount):
     Decided to punt on this to finish for the DjangoDash 2010.
     """
     
+    kind = models.ForeignKey(ResourceKind)
     building = models.ForeignKey(SettlementBuilding)
+    
+    owner_field = "building"
 
 
 class SettlementTerrainKind(BaseKind):
@@ -726,14 +1118,10 @@ class SettlementTerrain(models.Model):
     def __unicode__(self):
         return u"%s on %s" % (self.kind, self.settlement)
     
+    @memoized
     def resource_counts(self):
-        # @@@ instance cache
-        counts = []
-        for row in self.settlementterrainresourcecount_set.distinct().values("kind"):
-            kind = ResourceKind.objects.get(id=row["kind"])
-            current = SettlementTerrainResourceCount.current(kind, terrain=self)
-            counts.append(current)
-        return counts
+        counts = SettlementTerrainResourceCount.current_many([self])
+        return sorted(counts.values(), key=lambda rc: rc.kind_id)
 
 
 class SettlementTerrainResourceCount(BaseResourceCount):
@@ -746,3 +1134,199 @@ class SettlementTerrainResourceCount(BaseResourceCount):
     
     kind = models.ForeignKey(ResourceKind)
     terrain = models.ForeignKey(SettlementTerrain)
+    
+    owner_field = "terrain"
+
+
+class CatalogVersion(models.Model):
+    """
+    A counter (in a single row) bumped whenever the game data changes so
+    every process can tell its catalog is out of date (see
+    manoria.catalog).
+    """
+    
+    version = models.PositiveIntegerField(default=0)
+    
+    def __unicode__(self):
+        return u"catalog version %d" % self.version
+
+
+class LeaderboardEntry(LinearAmount, models.Model):
+    """
+    A materialized leaderboard position for a metric. Player resource kinds
+    (keyed by slug, e.g. gold) are ranked per player and "buildings" is
+    ranked per settlement.
+    
+    Resource amounts grow linearly, so the entry stores the current segment
+    (count, rate, timestamp, limit) which amount() projects to any instant,
+    and ranks on value: the amount as of when it was last projected. The
+    database orders on value straight off an index; refresh() (run by the
+    scheduler, or see the refresh_leaderboard command) brings the values of
+    growing entries up to date and re-projects those whose segment ended
+    at valid_until (the next resource count row).
+    """
+    
+    metric = models.CharField(max_length=50, db_index=True)
+    player = models.ForeignKey(Player)
+    settlement = models.ForeignKey(Settlement, null=True)
+    
+    count = models.IntegerField(default=0)
+    rate = models.FloatField(default=0)
+    timestamp = models.DateTimeField(default=clock.now)
+    limit = models.IntegerField(default=0)
+    value = models.IntegerField(default=0)
+    valid_until = models.DateTimeField(null=True, db_index=True)
+    
+    objects = LeaderboardManager()
+    
+    class Meta:
+        unique_together = [("metric", "player", "settlement")]
+    
+    def __unicode__(self):
+        return u"%s: %s" % (self.metric, self.leader)
+    
+    @property
+    def leader(self):
+        if self.settlement_id:
+            return self.settlement
+        return self.player
+    
+    def project(self, count, rate, timestamp, limit=0, valid_until=None, when=None):
+        """
+        Sets the segment the entry grows along and its value as of when (or
+        now).
+        """
+        self.count = count
+        self.rate = float(rate)
+        self.timestamp = timestamp
+        self.limit = limit
+        self.valid_until = valid_until
+        self.value = self.amount(when)
+    
+    @classmethod
+    def update_resource(cls, player, kind, when=None):
+        """
+        Re-projects the player's entry for a player resource kind from its
+        current resource count, counting one written as of when (such as
+        those of a player just created) from then on.
+        """
+        if when is None:
+            when = clock.now()
+        try:
+            current = PlayerResourceCount.current(kind, player=player, when=when, inclusive=True)
+        except IndexError:
+            return None
+        following = PlayerResourceCount.objects.filter(
+            kind=kind.pk, player=player, timestamp__gt=when
+        ).order_by("timestamp").values_list("timestamp", flat=True)[:1]
+        entry, _ = cls.objects.get_or_create(metric=kind.slug, player=player, settlement=None)
+        entry.project(current.count, current.rate, current.timestamp,
+            limit=current.limit,
+            valid_until=following[0] if following else None,
+            when=when,
+        )
+        entry.save()
+        return entry
+    
+    @classmethod
+    def update_buildings(cls, settlement):
+        """
+        Re-projects the settlement's entry from its count of buildings
+        (queued and built).
+        """
+        entry, _ = cls.objects.get_or_create(
+            metric="buildings", player=settlement.player, settlement=settlement
+        )
+        entry.project(settlement.building_count, 0, entry.timestamp)
+        entry.save()
+        return entry
+    
+    @classmethod
+    def refresh(cls, when=None):
+        """
+        Re-projects entries whose segment ended by the given time and
+        brings the value of every other growing (or shrinking) entry up to
+        it. Returns how many entries were re-projected.
+        """
+        if when is None:
+            when = clock.now()
+        stale = list(cls.objects.filter(valid_until__lte=when).select_related("player"))
+        kinds = get_catalog().resource_kinds_by_slug
+        for entry in stale:
+            cls.update_resource(entry.player, kinds[entry.metric], when=when)
+        growing = list(cls.objects.exclude(rate=0).values_list("pk", "count", "rate", "timestamp", "limit", "value"))
+        if growing:
+            pks, counts, rates, timestamps, limits, values = zip(*growing)
+            amounts = AmountEvaluator(counts, rates, timestamps, limits).amounts(when)
+            bulk_update(cls, "value", [
+                (pk, amount) for pk, value, amount in zip(pks, values, amounts) if amount != value
+            ])
+        return len(stale)
+    
+    @classmethod
+    def rebuild(cls, when=None):
+        """
+        Replaces every entry with one projected from the current resource
+        counts of every player and the building count of every settlement,
+        with a handful of queries however many there are. Returns how many
+        entries there now are.
+        """
+        if when is None:
+            when = clock.now()
+        kinds = get_catalog().resource_kind_list(player=True)
+        current = PlayerResourceCount.current_many(Player.objects.all(), kinds, when, inclusive=True)
+        following = PlayerResourceCount.objects.filter(kind__in=[kind.pk for kind in kinds], timestamp__gt=when)
+        following = dict([
+            ((row["player"], row["kind"]), row["next"])
+            for row in following.values("player", "kind").annotate(next=models.Min("timestamp"))
+        ])
+        entries = []
+        for (player_id, kind_id), resource_count in sorted(current.iteritems()):
+            entry = cls(metric=resource_count.kind.slug, player_id=player_id)
+            entry.count = resource_count.count
+            entry.rate = float(resource_count.rate)
+            entry.timestamp = resource_count.timestamp
+            entry.limit = resource_count.limit
+            entry.valid_until = following.get((player_id, kind_id))
+            entries.append(entry)
+        for entry, value in zip(entries, AmountEvaluator.of(entries).amounts(when)):
+            entry.value = value
+        for pk, player_id, building_count in Settlement.objects.order_by("pk").values_list("pk", "player", "building_count"):
+            entries.append(cls(metric="buildings", player_id=player_id, settlement_id=pk,
+                count=building_count, timestamp=when, value=building_count,
+            ))
+        cls.objects.all().delete()
+        bulk_insert(cls, entries)
+        return len(entries)
+
+
+def update_resource_leaderboard(sender, instance, **kwargs):
+    LeaderboardEntry.update_resource(instance.player, get_catalog().resource_kinds[instance.kind_id])
+
+
+def update_buildings_leaderboard(sender, instance, **kwargs):
+    LeaderboardEntry.update_buildings(instance.settlement)
+
+
+def remove_building(sender, instance, **kwargs):
+    now = clock.now()
+    Settlement.objects.filter(pk=instance.settlement_id).update(
+        version=models.F("version") + 1,
+        changed=now,
+        next_change=None,
+        building_count=models.F("building_count") - 1,
+        # makes the next refresh_state re-derive the completed count
+        next_completion=now,
+    )
+    # the instance's settlement (if there still is one) predates the update
+    for settlement in Settlement.objects.filter(pk=instance.settlement_id):
+        LeaderboardEntry.update_buildings(settlement)
+
+
+post_save.connect(update_resource_leaderboard, sender=PlayerResourceCount)
+post_save.connect(update_buildings_leaderboard, sender=SettlementBuilding)
+post_delete.connect(remove_building, sender=SettlementBuilding)
+for game_data_model in [ResourceKind, SettlementTerrainKind, BuildingKind, BuildingCost, BuildingRunningCost, BuildingKindProduct]:
+    post_save.connect(invalidate_catalog, sender=game_data_model)
+    post_delete.connect(invalidate_catalog, sender=game_data_model)
+m2m_changed.connect(invalidate_catalog, sender=SettlementTerrainKind.produces.through)
@@ -0,0 +1,208 @@
+import re
+import struct
+
+from django.db import models
+
+
+try:
+    memoryview
+except NameError:
+    # Python 2.6 has no memoryview; buffer is just as zero-copy for reading
+    memoryview = buffer
+
+
+LEGACY_CELL = re.compile(r"(\d+),(\d+)")
+
+# stored bitmaps start with a marker and the width and height of the map so
+# they read back at the size they were written at
+HEADER = struct.Struct(">4sHH")
+MAGIC = b"occ1"
+
+
+class Occupancy(object):
+    """
+    Which cells of a map (a continent or a settlement) are taken, as one bit
+    per cell. Cells are numbered column by column, so iterating in bit order
+    visits x in the outer loop and y in the inner one like the rest of the
+    map code does.
+    
+    The bits are read through a memoryview over whatever buffer they came
+    in (the value straight from the database) and only copied into a
+    bytearray when a cell is first changed.
+    """
+    
+    def __init__(self, size, data=None):
+        self.width, self.height = size
+        length = (self.width * self.height + 7) // 8
+        if data is None:
+            data = bytearray(length)
+        self._data = data
+        self._view = memoryview(data)
+        if len(self._view) != length:
+            raise ValueError("%d bytes do not describe a %dx%d map" % (len(self._view), self.width, self.height))
+    
+    @classmethod
+    def from_text(cls, size, text):
+        """
+        Parses the space-separated "x,y" format allocations used to be
+        stored in.
+        """
+        occupancy = cls(size)
+        for x, y in LEGACY_CELL.findall(text):
+            occupancy.occupy(int(x), int(y))
+        return occupancy
+    
+    @classmethod
+    def frombytes(cls, data, size=None):
+        """
+        Reads a bitmap written by tobytes, at the size stored with it.
+        Bitmaps stored without a size are taken to be of the given size.
+        """
+        view = memoryview(data)
+        if cls.has_header(view):
+            magic, width, height = HEADER.unpack(view[:HEADER.size].tobytes())
+            return cls((width, height), view[HEADER.size:])
+        if size is None:
+            raise ValueError("the bitmap does not say what size of map it describes")
+        return cls(size, data)
+    
+    @staticmethod
+    def has_header(data):
+        """
+        Whether stored bytes start with the size of the map they describe.
+        """
+        view = memoryview(data)
+        return len(view) >= HEADER.size and view[:len(MAGIC)].tobytes() == MAGIC
+    
+    def to_text(self):
+        return " ".join(["%d,%d" % cell for cell in self])
+    
+    @property
+    def size(self):
+        return self.width, self.height
+    
+    def tobytes(self):
+        """
+        The bitmap as stored: a header with the size of the map followed by
+        the bits.
+        """
+        return HEADER.pack(MAGIC, self.width, self.height) + self._view.tobytes()
+    
+    def _bit(self, x, y):
+        if not 1 <= x <= self.width or not 1 <= y <= self.height:
+            raise IndexError("%d,%d is not on a %dx%d map" % (x, y, self.width, self.height))
+        return (x - 1) * self.height + (y - 1)
+    
+    def _byte(self, i):
+        byte = self._view[i]
+        # a character on Python 2, an int on Python 3
+        if not isinstance(byte, int):
+            byte = ord(byte)
+        return byte
+    
+    def is_occupied(self, x, y):
+        bit = self._bit(x, y)
+        return bool(self._byte(bit >> 3) & (1 << (bit & 7)))
+    
+    def is_free(self, x, y):
+        return not self.is_occupied(x, y)
+    
+    def __contains__(self, cell):
+        return self.is_occupied(*cell)
+    
+    def _set(self, x, y, value):
+        bit = self._bit(x, y)
+        if not isinstance(self._data, bytearray):
+            self._data = bytearray(self._view.tobytes())
+            self._view = memoryview(self._data)
+        if value:
+            self._data[bit >> 3] |= 1 << (bit & 7)
+        else:
+            self._data[bit >> 3] &= ~(1 << (bit & 7)) & 0xff
+    
+    def occupy(self, x, y):
+        self._set(x, y, True)
+    
+    def release(self, x, y):
+        self._set(x, y, False)
+    
+    def _cells(self, occupied):
+        # whole bytes of free (or taken) cells are skipped in one test
+        if occupied:
+            skip = 0x00
+        else:
+            skip = 0xff
+        total = self.width * self.height
+        for i in range(len(self._view)):
+            byte = self._byte(i)
+            if byte == skip:
+                continue
+            for bit in range(i << 3, min((i + 1) << 3, total)):
+                if bool(byte & (1 << (bit & 7))) == occupied:
+                    yield bit // self.height + 1, bit % self.height + 1
+    
+    def __iter__(self):
+        """
+        Yields the occupied cells as (x, y).
+        """
+        return self._cells(True)
+    
+    def free_cells(self):
+        """
+        Yields the free cells as (x, y).
+        """
+        return self._cells(False)
+    
+    def __len__(self):
+        return sum([bin(self._byte(i)).count("1") for i in range(len(self._view))])
+
+
+class OccupancyField(models.Field):
+    """
+    Stores an Occupancy as raw bytes (the size of the map then one bit per
+    cell). New maps are of the given size; stored ones keep the size they
+    were written at, so changing it leaves existing rows readable. Values
+    still in the old "x,y" text format (or bits stored without a size) are
+    taken to be of the given size; text is parsed on load and is what the
+    field serializes to.
+    """
+    
+    __metaclass__ = models.SubfieldBase
+    
+    BINARY_TYPES = {
+        "sqlite3": "blob",
+        "postgresql": "bytea",
+        "postgresql_psycopg2": "bytea",
+        "mysql": "longblob",
+        "oracle": "blob",
+    }
+    
+    def __init__(self, size, *args, **kwargs):
+        self.size = size
+        kwargs["editable"] = False
+        super(OccupancyField, self).__init__(*args, **kwargs)
+    
+    def db_type(self, connection):
+        engine = connection.settings_dict["ENGINE"].split(".")[-1]
+        return self.BINARY_TYPES[engine]
+    
+    def get_default(self):
+        return Occupancy(self.size)
+    
+    def to_python(self, value):
+        if isinstance(value, Occupancy):
+            return value
+        if value is None:
+            return Occupancy(self.size)
+        if isinstance(value, basestring) and not isinstance(value, str):
+            # unicode only comes from a text column or a fixture
+            return Occupancy.from_text(self.size, value)
+        return Occupancy.frombytes(value, self.size)
+    
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if value is None:
+            return None
+        return buffer(self.to_python(value).tobytes())
+    
+    def value_to_string(self, obj):
+        return self._get_val_from_obj(obj).to_text()
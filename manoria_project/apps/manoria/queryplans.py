@@ -0,0 +1,67 @@
+import re
+
+from django.db import connection
+
+from manoria import clock
+from manoria.models import PlayerResourceCount, SettlementResourceCount
+from manoria.models import SettlementBuildingResourceCount, SettlementTerrainResourceCount
+from manoria.models import LeaderboardEntry, ResourceKind, Settlement, SettlementBuilding
+
+
+# an EXPLAIN QUERY PLAN line which reads a whole table rather than an index
+FULL_SCAN = re.compile(r"^SCAN (TABLE )?(?P<table>\w+)(?! USING)( \(|$)")
+
+# an EXPLAIN QUERY PLAN line which sorts rows the index should have given in
+# order
+TEMP_SORT = re.compile(r"^USE TEMP B-TREE FOR ORDER BY")
+
+
+def hot_queries():
+    """
+    Yields (name, queryset) for the queries on the game's hot paths. Owner
+    and kind ids are placeholders; the plans do not depend on the data.
+    """
+    now = clock.now()
+    kind = ResourceKind(pk=1)
+    resource_count_models = [
+        PlayerResourceCount,
+        SettlementResourceCount,
+        SettlementTerrainResourceCount,
+        SettlementBuildingResourceCount,
+    ]
+    for ResourceCount in resource_count_models:
+        name = ResourceCount.__name__
+        owner_field = ResourceCount.owner_field
+        owner = {owner_field: 1}
+        rows = ResourceCount._default_manager
+        yield "%s.current" % name, rows.filter(
+            kind=kind, timestamp__lt=now, **owner
+        ).order_by("-timestamp")[:1]
+        yield "%s.current_queryset" % name, ResourceCount.current_queryset([1], [kind], now)
+        yield "%s future rows" % name, rows.filter(
+            kind=kind, timestamp__gt=now, **owner
+        ).order_by("timestamp")
+        yield "%s timeline" % name, rows.filter(kind=kind, **owner).order_by("timestamp", "id")
+    settlement = Settlement(pk=1, next_completion=now)
+    yield "Settlement.build_queue", settlement.build_queue_queryset()
+    yield "Settlement.buildings", settlement.buildings_queryset()
+    yield "SettlementBuilding at cell", SettlementBuilding.objects.filter(settlement=settlement, x=1, y=1)
+    yield "LeaderboardEntry.refresh", LeaderboardEntry.objects.filter(valid_until__lte=now)
+    yield "LeaderboardEntry.ranked", LeaderboardEntry.objects.ranked("gold")[:25]
+    yield "LeaderboardEntry.rank", LeaderboardEntry.objects.filter(metric="gold", value__gt=0)
+    yield "Worker.step", Settlement.objects.filter(next_change__isnull=True)
+
+
+def query_plan(queryset):
+    sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+    cursor = connection.cursor()
+    cursor.execute("EXPLAIN QUERY PLAN %s" % sql, params)
+    return [row[-1] for row in cursor.fetchall()]
+
+
+def plan_problems(plan):
+    """
+    The lines of a query plan which read a whole table or sort in a
+    temporary b-tree.
+    """
+    return [line for line in plan if FULL_SCAN.match(line) or TEMP_SORT.match(line)]
@@ -0,0 +1,108 @@
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.template import Context
+from django.template.loader import get_template
+from django.utils.safestring import mark_safe
+
+from manoria.models import Continent, Settlement, SettlementBuilding, SettlementTerrain
+
+
+class EmptyCell(object):
+    def __init__(self, x, y, mapable):
+        self.x = x
+        self.y = y
+        self.mapable = mapable
+    
+    def create_url(self):
+        if isinstance(self.mapable, Continent):
+            # return reverse("settlement_create")
+            return None
+        elif isinstance(self.mapable, Settlement):
+            return reverse("building_create", args=(self.mapable.pk,))
+
+
+class MapRenderer(object):
+    """
+    Renders the cells of a map (a continent or a settlement) in a single
+    pass with cell templates compiled once per process. Rendered maps are
+    cached under the state version of the mapable, so a map only has to be
+    rendered again once something on it changed (the scheduler bumps the
+    version as buildings move on through the build queue).
+    """
+    
+    templates = {
+        EmptyCell: "manoria/_map_empty_cell.html",
+        Settlement: "manoria/_map_settlement.html",
+        SettlementBuilding: "manoria/_map_building.html",
+        SettlementTerrain: "manoria/_map_terrain.html",
+    }
+    
+    _compiled = {}
+    
+    def __init__(self, mapable):
+        self.mapable = mapable
+    
+    @classmethod
+    def template(cls, cell_class):
+        try:
+            return cls._compiled[cell_class]
+        except KeyError:
+            template = cls._compiled[cell_class] = get_template(cls.templates[cell_class])
+            return template
+    
+    def cache_key(self):
+        return "manoria:map:%s:%s:%d" % (
+            self.mapable._meta.module_name, self.mapable.pk, self.mapable.version
+        )
+    
+    def render(self):
+        """
+        Returns the cells of the map as HTML, from the cache when the map has
+        not changed since it was last rendered.
+        """
+        key = self.cache_key()
+        html = cache.get(key)
+        if html is None:
+            html = self.render_cells()
+            cache.set(key, html)
+        return mark_safe(html)
+    
+    def render_cells(self):
+        """
+        Renders every cell of the map.
+        """
+        context = Context()
+        bits = []
+        
+        # only settlements link their empty cells anywhere
+        empty = EmptyCell(0, 0, self.mapable)
+        create_url = empty.create_url()
+        if create_url:
+            for x, y in self.mapable.allocation.free_cells():
+                empty.x, empty.y = x, y
+                bits.append(self.render_cell(empty, context, create_url=create_url))
+        
+        for cell in self.mapable.cells():
+            bits.append(self.render_cell(cell, context))
+        return "".join(bits)
+    
+    @classmethod
+    def render_cell(cls, cell, context=None, **extra):
+        """
+        Renders a single cell (with any extra template variables) in the
+        given context, which is left as it was found.
+        """
+        if context is None:
+            context = Context()
+        values = {
+            "cell": cell,
+            # building size + border + padding
+            "left": cell.x * 86,
+            "top": cell.y * 86,
+        }
+        values.update(extra)
+        context.update(values)
+        try:
+            return cls.template(type(cell)).render(context)
+        finally:
+            context.pop()
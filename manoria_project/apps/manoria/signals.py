@@ -0,0 +1,6 @@
+from django.dispatch import Signal
+
+
+# sent by the scheduler worker (see run_scheduler) as a building finishes
+# being built
+building_completed = Signal(providing_args=["building", "when"])
@@ -0,0 +1,115 @@
+from manoria import clock
+from manoria.catalog import get_catalog
+from manoria.models import PlayerResourceCount, Settlement, SettlementBuilding, SettlementResourceCount
+from manoria.timeline import TimelineCache, first_change, to_microseconds
+
+
+def to_milliseconds(when):
+    return int(to_microseconds(when) / 1000)
+
+
+def milliseconds_until(when, now):
+    """
+    Milliseconds from now until when (None if when is None).
+    """
+    if when is None:
+        return None
+    change = when - now
+    return (change.days * 86400 + change.seconds) * 1000.0 + change.microseconds / 1000.0
+
+
+def resources(timelines, kinds, now):
+    """
+    Amounts, limits and rates as of now, ordered by kind, of (owner pk, kind
+    pk) keyed timelines such as TimelineCache.prefetch returns; grouped by
+    owner pk.
+    """
+    owners = {}
+    for (owner_pk, kind_id), timeline in sorted(timelines.items()):
+        try:
+            current = timeline.current(now)
+        except IndexError:
+            continue
+        owners.setdefault(owner_pk, []).append({
+            "slug": kinds[kind_id].slug,
+            "amount": current.amount(now),
+            "limit": current.limit,
+            "rate": current.rate,
+        })
+    return owners
+
+
+def resource_snapshot(settlement, now=None):
+    """
+    The amounts and rates of the settlement's resources as of now with when
+    (milliseconds after the snapshot's timestamp) the next of them changes.
+    The rates hold until then so clients can interpolate amounts until it.
+    """
+    if now is None:
+        now = clock.now()
+    
+    # compile every resource timeline of the settlement in one query and
+    # answer the amounts from it
+    timelines = TimelineCache().prefetch(SettlementResourceCount, [settlement])
+    kinds = get_catalog().resource_kinds
+    due, upcoming = settlement.scheduled_state(now, timelines)
+    
+    return {
+        "timestamp": to_milliseconds(now),
+        "next_change": milliseconds_until(upcoming, now),
+        "resources": resources(timelines, kinds, now).get(settlement.pk, []),
+    }
+
+
+def player_snapshot(player, now=None):
+    """
+    Snapshots of the player's own resources and of those of every one of
+    the player's settlements, from a fixed number of queries however many
+    settlements there are.
+    """
+    if now is None:
+        now = clock.now()
+    
+    settlements = list(Settlement.objects.filter(player=player).order_by("pk"))
+    settlement_timelines = TimelineCache().prefetch(SettlementResourceCount, settlements)
+    player_timelines = TimelineCache().prefetch(PlayerResourceCount, [player])
+    kinds = get_catalog().resource_kinds
+    settlement_resources = resources(settlement_timelines, kinds, now)
+    
+    # when each settlement next changes, worked out (without saving) from
+    # the timelines already compiled plus one query for the build queues of
+    # those whose stored state is out of date
+    timelines = {}
+    for (settlement_pk, kind_id), timeline in settlement_timelines.iteritems():
+        timelines.setdefault(settlement_pk, {})[(settlement_pk, kind_id)] = timeline
+    stale = [settlement for settlement in settlements if settlement.is_stale(now)]
+    builds = {}
+    if stale:
+        queue = SettlementBuilding.objects.filter(
+            settlement__in=stale,
+            construction_end__gt=min([settlement.changed or now for settlement in stale]),
+        )
+        for settlement_pk, start, end in queue.values_list("settlement", "construction_start", "construction_end"):
+            builds.setdefault(settlement_pk, []).append((start, end))
+    upcoming = {}
+    for settlement in settlements:
+        due, upcoming[settlement.pk] = settlement.scheduled_state(now,
+            timelines.get(settlement.pk, {}), builds.get(settlement.pk, [])
+        )
+    
+    return {
+        "timestamp": to_milliseconds(now),
+        "player": {
+            "next_change": milliseconds_until(first_change(player_timelines.values(), now), now),
+            "resources": resources(player_timelines, kinds, now).get(player.pk, []),
+        },
+        "settlements": [
+            {
+                "pk": settlement.pk,
+                "name": settlement.name,
+                "next_change": milliseconds_until(upcoming[settlement.pk], now),
+                "resources": settlement_resources.get(settlement.pk, []),
+            }
+            for settlement in settlements
+        ],
+    }
@@ -0,0 +1,3 @@
+-- covers LeaderboardManager.ranked() and rank(): equality on the metric
+-- followed by an ordering/range on value
+CREATE INDEX manoria_leaderboardentry_ranking ON manoria_leaderboardentry (metric, value);
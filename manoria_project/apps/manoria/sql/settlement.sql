@@ -0,0 +1,2 @@
+-- covers the scheduler worker's polls for changed and due settlements
+CREATE INDEX manoria_settlement_next_change ON manoria_settlement (next_change);
@@ -0,0 +1,2 @@
+-- covers build_queue() and buildings()
+CREATE INDEX manoria_settlementbuilding_construction ON manoria_settlementbuilding (settlement_id, construction_end, construction_start);
@@ -0,0 +1,3 @@
+-- covers current(), current_queryset() and timeline loads: equality on the
+-- owner and kind followed by a range/ordering on timestamp
+CREATE INDEX manoria_settlementresourcecount_timeline ON manoria_settlementresourcecount (settlement_id, kind_id, timestamp);
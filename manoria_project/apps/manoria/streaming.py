@@ -0,0 +1,135 @@
+import datetime
+import heapq
+import threading
+
+from django.db import connection
+from django.utils import simplejson as json
+
+from manoria import clock
+from manoria.models import Settlement
+from manoria.snapshots import resource_snapshot
+
+
+# idle streams send a comment this often (seconds) which also picks up
+# changes made by other processes
+STREAM_HEARTBEAT = 15
+
+# streams are ended after this long (seconds) and the browser reconnects,
+# so a server thread is never tied up by one client forever
+STREAM_LIFETIME = 600
+
+# how long (milliseconds) the browser waits before reconnecting
+STREAM_RETRY = 3000
+
+
+class Scheduler(object):
+    """
+    Wakes streams waiting on a settlement when its next scheduled change is
+    due or when told the settlement changed (views do so once the change is
+    committed; changes made elsewhere are noticed on the next heartbeat).
+    One scheduler (and one timer thread) is shared by every stream in the
+    process, however many are open.
+    """
+    
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._waiting = {}
+        self._due = []
+        self._scheduled = set()
+        self._thread = None
+    
+    def wait(self, settlement_pk, until=None, timeout=None):
+        """
+        Blocks until the settlement is woken, until is reached or timeout
+        seconds pass. Returns True if it was woken (rather than timed out).
+        """
+        event = threading.Event()
+        self._condition.acquire()
+        try:
+            self._waiting.setdefault(settlement_pk, set()).add(event)
+            if until is not None and (until, settlement_pk) not in self._scheduled:
+                self._scheduled.add((until, settlement_pk))
+                heapq.heappush(self._due, (until, settlement_pk))
+                self._start()
+                self._condition.notify()
+        finally:
+            self._condition.release()
+        try:
+            event.wait(timeout)
+            return event.isSet()
+        finally:
+            self._condition.acquire()
+            try:
+                waiting = self._waiting.get(settlement_pk)
+                waiting.discard(event)
+                if not waiting:
+                    del self._waiting[settlement_pk]
+            finally:
+                self._condition.release()
+    
+    def wake(self, settlement_pk):
+        self._condition.acquire()
+        try:
+            for event in self._waiting.get(settlement_pk, ()):
+                event.set()
+        finally:
+            self._condition.release()
+    
+    def _start(self):
+        if self._thread is None or not self._thread.isAlive():
+            self._thread = threading.Thread(target=self._run, name="manoria-scheduler")
+            self._thread.setDaemon(True)
+            self._thread.start()
+    
+    def _run(self):
+        self._condition.acquire()
+        try:
+            while True:
+                now = clock.get_clock().now()
+                while self._due and self._due[0][0] <= now:
+                    due = heapq.heappop(self._due)
+                    self._scheduled.discard(due)
+                    settlement_pk = due[1]
+                    for event in self._waiting.get(settlement_pk, ()):
+                        event.set()
+                if self._due:
+                    self._condition.wait(clock.get_clock().seconds(self._due[0][0] - now))
+                else:
+                    self._condition.wait()
+        finally:
+            self._condition.release()
+
+
+scheduler = Scheduler()
+
+
+def event_stream(settlement_pk, lifetime=STREAM_LIFETIME, heartbeat=STREAM_HEARTBEAT):
+    """
+    Yields a server-sent event with a resource snapshot of the settlement,
+    then nothing but heartbeats until its state changes (it is written to
+    or a scheduled change comes due), when the next snapshot is sent.
+    Nothing is saved; game time is read off the clock rather than the (long
+    gone) request's instant.
+    """
+    started = datetime.datetime.now()
+    sent = None
+    try:
+        yield "retry: %d\n\n" % STREAM_RETRY
+        while datetime.datetime.now() - started < datetime.timedelta(seconds=lifetime):
+            now = clock.get_clock().now()
+            settlement = Settlement.objects.get(pk=settlement_pk)
+            due, upcoming = settlement.scheduled_state(now)
+            state = (settlement.version, due)
+            if state != sent:
+                sent = state
+                data = json.dumps(resource_snapshot(settlement, now), use_decimal=True)
+                yield "data: %s\n\n" % data
+            else:
+                yield ": heartbeat\n\n"
+            # nothing to read until woken; don't hold the connection open
+            connection.close()
+            scheduler.wait(settlement_pk, upcoming, heartbeat)
+    finally:
+        # the stream outlives the request the connection was opened for
+        connection.close()
+
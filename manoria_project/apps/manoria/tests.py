@@ -0,0 +1,494 @@
+import datetime
+import random
+import unittest
+
+from django.conf import settings
+from django.core.signals import request_finished, request_started
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.db.models import F
+from django.test import TestCase
+
+from django.contrib.auth.models import User
+
+from manoria import catalog, clock, instrumentation, timeline
+from manoria.adjacency import SettlementGrid
+from manoria.benchmarks.cases import PLACE_QUERY_LIMIT, QUEUE_QUERY_LIMIT
+from manoria.catalog import get_catalog
+from manoria.compaction import fold
+from manoria.models import CatalogVersion, Continent, LeaderboardEntry, Player, ResourceKind, Settlement
+from manoria.models import SettlementBuilding, SettlementResourceCount
+from manoria.occupancy import Occupancy, OccupancyField
+from manoria.queryplans import hot_queries, plan_problems, query_plan
+from manoria.signals import building_completed
+from manoria.snapshots import player_snapshot
+from manoria.timeline import AmountEvaluator, ResourceTimeline, TimelineEntry, first_change
+from manoria.utils import WeightedSampler, weighted_choices
+from manoria.worker import Worker
+
+
+def count_queries(func):
+    """
+    Calls func and returns how many queries it issued (whether or not DEBUG
+    is on).
+    """
+    instrumentation.install()
+    instrumentation.start()
+    try:
+        func()
+    finally:
+        recorder = instrumentation.stop()
+    return recorder.queries
+
+
+class WorkerTest(TestCase):
+    
+    def setUp(self):
+        self.clock = clock.SimulatedClock(speed=0)
+        self.real_clock = clock.set_clock(self.clock)
+        
+        user = User.objects.create_user("worker", "worker@example.com", "password")
+        player = Player.objects.create(user=user, name="worker")
+        self.settlement = Settlement(name="workerville", player=player, continent=Continent.objects.get(pk=1))
+        self.settlement.place()
+        SettlementResourceCount.objects.filter(settlement=self.settlement).update(count=100000)
+        # resource counts only hold from after their timestamp
+        self.clock.advance(minutes=1)
+        self.client.login(username="worker", password="password")
+        
+        self.completed = []
+        building_completed.connect(self.building_completed)
+    
+    def tearDown(self):
+        building_completed.disconnect(self.building_completed)
+        clock.set_clock(self.real_clock)
+    
+    def building_completed(self, sender, building, when, **kwargs):
+        self.completed.append(building.pk)
+    
+    def queue_building(self):
+        grid = SettlementGrid.load(self.settlement)
+        SX, SY = grid.size
+        x, y = [
+            (x, y) for x in range(1, SX + 1) for y in range(1, SY + 1)
+            if grid.terrain_at(x, y) is None and grid.building_at(x, y) is None
+        ][0]
+        building = SettlementBuilding(settlement=self.settlement,
+            kind_id=get_catalog().building_kind_list()[0].pk, x=x, y=y,
+        )
+        building.queue(grid=grid)
+        return building
+    
+    def test_building_completed_after_request(self):
+        worker = Worker()
+        worker.load()
+        worker.step()
+        
+        building = self.queue_building()
+        # pages looking at the settlement before the worker does leave its
+        # state for the worker to pick up
+        for name in ["settlement_detail", "ajax_resource_count", "fragment_resource_count",
+            "fragment_build_queue", "fragment_settlement_map"]:
+            response = self.client.get(reverse(name, args=(self.settlement.pk,)))
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get(reverse("ajax_player_resource_count")).status_code, 200)
+        self.assertEqual(Settlement.objects.get(pk=self.settlement.pk).next_change, None)
+        
+        worker.step()
+        self.clock.advance(seconds=get_catalog().building_kinds[building.kind_id].build_time)
+        worker.step()
+        self.assertEqual(self.completed, [building.pk])
+        
+        settlement = Settlement.objects.get(pk=self.settlement.pk)
+        self.assertEqual(settlement.queued_building_count, 0)
+    
+    def test_build_queue_from_stored_state(self):
+        worker = Worker()
+        worker.load()
+        first, second = self.queue_building(), self.queue_building()
+        settlement = Settlement.objects.get(pk=self.settlement.pk)
+        self.assertEqual([b.status() for b in settlement.build_queue()], ["under construction", "queued"])
+        
+        # the queue moves on when the scheduler says so, not before
+        self.clock.advance(seconds=get_catalog().building_kinds[first.kind_id].build_time)
+        settlement = Settlement.objects.get(pk=self.settlement.pk)
+        self.assertEqual([b.pk for b in settlement.build_queue()], [first.pk, second.pk])
+        worker.step()
+        settlement = Settlement.objects.get(pk=self.settlement.pk)
+        self.assertEqual([b.pk for b in settlement.build_queue()], [second.pk])
+        self.assertEqual([b.pk for b in settlement.buildings()], [first.pk])
+        self.assertEqual(SettlementBuilding.objects.get(pk=first.pk).status(), "built")
+        self.assertEqual(SettlementBuilding.objects.get(pk=second.pk).status(), "under construction")
+    
+    def test_polls_revalidated(self):
+        url = reverse("fragment_resource_count", args=(self.settlement.pk,))
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response["ETag"]
+        
+        # a 304 only loads the session, the user and the settlement (the
+        # catalog version is not due to be checked again)
+        responses = []
+        interval, catalog.VERSION_CHECK_INTERVAL = catalog.VERSION_CHECK_INTERVAL, 3600
+        try:
+            queries = count_queries(lambda: responses.append(self.client.get(url, HTTP_IF_NONE_MATCH=etag)))
+        finally:
+            catalog.VERSION_CHECK_INTERVAL = interval
+        self.assertEqual(responses[0].status_code, 304)
+        self.assertEqual(queries, 3)
+        
+        self.queue_building()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        
+        User.objects.create_user("other", "other@example.com", "password")
+        self.client.login(username="other", password="password")
+        self.assertEqual(self.client.get(url).status_code, 404)
+    
+    def test_memoized_for_the_request(self):
+        self.queue_building()
+        request_started.send(sender=self.__class__)
+        try:
+            settlement = Settlement.objects.get(pk=self.settlement.pk)
+            queue = settlement.build_queue()
+            self.assertEqual(len(queue), 1)
+            # another instance of the same row shares the list, kinds and all
+            again = Settlement.objects.get(pk=self.settlement.pk)
+            self.assertEqual(count_queries(lambda: [b.kind for b in again.build_queue()]), 0)
+            # the map only adds the finished buildings and the terrain
+            self.assertEqual(count_queries(again.cells), 2)
+        finally:
+            request_finished.send(sender=self.__class__)
+        # nothing is kept once the request is over
+        self.assertNotEqual(count_queries(settlement.build_queue), 0)
+    
+    def test_build_queue_in_game_time(self):
+        # game time is days ahead of the wall clock
+        self.clock.advance(days=2)
+        self.queue_building()
+        response = self.client.get(reverse("fragment_build_queue", args=(self.settlement.pk,)))
+        self.assertContains(response, "minute")
+        self.assertNotContains(response, "day")
+    
+    def test_stream_owner_only(self):
+        streaming, settings.RESOURCE_STREAMING = settings.RESOURCE_STREAMING, True
+        try:
+            url = reverse("stream_resource_count", args=(self.settlement.pk,))
+            self.client.logout()
+            self.assertEqual(self.client.get(url).status_code, 302)
+            User.objects.create_user("other", "other@example.com", "password")
+            self.client.login(username="other", password="password")
+            self.assertEqual(self.client.get(url).status_code, 404)
+        finally:
+            settings.RESOURCE_STREAMING = streaming
+
+
+class LeaderboardTest(TestCase):
+    
+    def setUp(self):
+        self.clock = clock.SimulatedClock(speed=0)
+        self.real_clock = clock.set_clock(self.clock)
+    
+    def tearDown(self):
+        clock.set_clock(self.real_clock)
+    
+    def test_new_player_ranked(self):
+        User.objects.create_user("newcomer", "newcomer@example.com", "password")
+        self.client.login(username="newcomer", password="password")
+        response = self.client.post(reverse("player_create"), {"name": "newcomer"})
+        self.assertEqual(response.status_code, 302)
+        entry = LeaderboardEntry.objects.get(metric="gold", player__name="newcomer")
+        self.assertEqual(entry.value, 0)
+        self.assertEqual(LeaderboardEntry.objects.rank(entry), 1)
+        self.assertContains(self.client.get(reverse("leaderboard")), "newcomer")
+
+
+class ResourceCountTest(TestCase):
+    
+    def setUp(self):
+        self.clock = clock.SimulatedClock(speed=0)
+        self.real_clock = clock.set_clock(self.clock)
+        user = User.objects.create_user("counter", "counter@example.com", "password")
+        player = Player.objects.create(user=user, name="counter")
+        self.settlement = Settlement(name="countville", player=player, continent=Continent.objects.get(pk=1))
+        self.settlement.place()
+        self.start = clock.now()
+        kind = get_catalog().resource_kind_list(player=False)[0]
+        for hours, count in [(1, 500), (3, 200)]:
+            SettlementResourceCount.objects.create(settlement=self.settlement, kind_id=kind.pk,
+                count=count, natural_rate=10, rate_adjustment=0, limit=0,
+                timestamp=self.start + datetime.timedelta(hours=hours),
+            )
+    
+    def tearDown(self):
+        clock.set_clock(self.real_clock)
+    
+    def test_current_many_matches_current(self):
+        kinds = get_catalog().resource_kind_list(player=False)
+        for minutes in [1, 60, 61, 150, 180, 300]:
+            when = self.start + datetime.timedelta(minutes=minutes)
+            for inclusive in [False, True]:
+                many = []
+                queries = count_queries(lambda: many.append(
+                    SettlementResourceCount.current_many([self.settlement], kinds, when, inclusive)
+                ))
+                self.assertEqual(queries, 1)
+                for kind in kinds:
+                    one = SettlementResourceCount.current(kind, settlement=self.settlement,
+                        when=when, inclusive=inclusive,
+                    )
+                    self.assertEqual(many[0][(self.settlement.pk, kind.pk)].pk, one.pk)
+
+
+class ResourceTimelineTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.start = datetime.datetime(2010, 8, 28, 12, 0)
+        # runs out at +10h but is replaced at +5h by one which fills up at +10h
+        self.rows = [
+            TimelineEntry(1, self.start, 100, -10, 0, 0),
+            TimelineEntry(2, self.at(5), 500, 80, 20, 1000),
+        ]
+        self.timeline = ResourceTimeline(self.rows)
+    
+    def at(self, hours):
+        return self.start + datetime.timedelta(hours=hours)
+    
+    def test_amount(self):
+        for hours in [0.5, 2, 5, 5.5, 7, 12, 30]:
+            when = self.at(hours)
+            # a row only holds from after its timestamp
+            current = [row for row in self.rows if row.timestamp < when][-1]
+            self.assertEqual(self.timeline.amount(when), current.amount(when))
+        self.assertEqual(self.timeline.amount(self.at(5)), 50)
+        self.assertEqual(self.timeline.amount(self.at(30)), 1000)
+        self.assertRaises(IndexError, self.timeline.amount, self.start)
+    
+    def test_next_extremum(self):
+        self.assertEqual(self.timeline.next_extremum(self.at(1)), (self.at(10), True))
+        self.assertEqual(self.timeline.next_extremum(self.at(12)), (self.at(10), True))
+        empty = ResourceTimeline([TimelineEntry(1, self.start, 100, 0, 0, 0)])
+        self.assertEqual(empty.next_extremum(self.at(1)), (None, None))
+    
+    def test_first_change(self):
+        self.assertEqual(self.timeline.next_change(self.at(1)), self.at(5))
+        self.assertEqual(first_change([self.timeline], self.at(1)), self.at(5))
+        self.assertEqual(first_change([self.timeline], self.at(6)), self.at(10))
+        self.assertEqual(first_change([self.timeline], self.at(12)), None)
+        # timelines which have not started yet are passed over
+        self.assertEqual(first_change([self.timeline], self.start - datetime.timedelta(hours=1)), self.start)
+
+
+class AmountEvaluatorTest(unittest.TestCase):
+    
+    def test_amounts(self):
+        start = datetime.datetime(2010, 8, 28, 12, 0)
+        rows = [
+            TimelineEntry(1, start, 100, -10, 0, 0),
+            TimelineEntry(2, start, 500, 80, 20, 1000),
+            TimelineEntry(3, start + datetime.timedelta(minutes=7), 0, 0, 0, 0),
+            TimelineEntry(4, start, 2, 0.5, 0, 3),
+        ]
+        numpy = timeline.numpy
+        try:
+            # with NumPy (if it is installed) and without
+            for timeline.numpy in [numpy, None]:
+                evaluator = AmountEvaluator.of(rows)
+                for hours in [0, 0.25, 1, 5.5, 12, 30]:
+                    when = start + datetime.timedelta(hours=hours, seconds=1.5)
+                    self.assertEqual(evaluator.amounts(when), [row.amount(when) for row in rows])
+        finally:
+            timeline.numpy = numpy
+
+
+class CompactionTest(unittest.TestCase):
+    
+    def test_fold(self):
+        start = datetime.datetime(2010, 8, 28, 12, 0)
+        hour = datetime.timedelta(hours=1)
+        rows = [
+            # (id, owner, kind, timestamp, count, natural_rate, rate_adjustment, limit)
+            (1, 1, 1, start, 100, 10, 0, 0),
+            (2, 1, 1, start + hour, 200, 15, 5, 0),
+            (3, 1, 1, start + 2 * hour, 0, 0, 0, 0),
+            # nothing to fold
+            (4, 1, 2, start, 100, 10, 0, 0),
+            # one row before the current one is kept; one sharing its
+            # timestamp is never current and goes
+            (5, 2, 1, start, 100, 10, 0, 0),
+            (6, 2, 1, start + hour, 300, 0, 0, 0),
+            (7, 2, 1, start + hour, 400, 0, 0, 0),
+        ]
+        folded = list(fold(iter(rows)))
+        self.assertEqual(folded, [
+            (1, 1, [1, 2], {
+                "timestamp": start,
+                "count": 220,
+                "natural_rate": 0,
+                "rate_adjustment": 0,
+                "limit": 0,
+            }),
+            (2, 1, [6], None),
+        ])
+
+
+class WeightedSamplerTest(unittest.TestCase):
+    
+    population = [("forest", 3), ("lake", 1), ("hill", 0), ("mountain", 6), ("meadow", 2)]
+    
+    def test_draw_matches_expanded_population(self):
+        expanded = [choice for choice, weight in self.population for i in range(weight)]
+        sampler = WeightedSampler(self.population)
+        ours, theirs = random.Random(7), random.Random(7)
+        for i in range(1000):
+            self.assertEqual(sampler.draw(ours), expanded[int(theirs.random() * len(expanded))])
+    
+    def test_sample_matches_expand_and_choose(self):
+        def expand_and_choose(k, rng):
+            # what weighted_choices used to do, drawing from rng
+            s = [choice for choice, weight in self.population for i in range(weight)]
+            results = []
+            while s and len(results) < k:
+                r = s[int(rng.random() * len(s))]
+                results.append(r)
+                s = [item for item in s if item != r]
+            return results
+        sampler = WeightedSampler(self.population)
+        ours, theirs = random.Random(7), random.Random(7)
+        for k in list(range(1, 7)) * 20:
+            taken = sampler.sample(k, ours)
+            self.assertEqual(taken, expand_and_choose(k, theirs))
+            self.assertEqual(len(taken), min(k, 4))
+        # taking choices out leaves the sampler as it was
+        self.assertEqual(sampler.total, 12)
+    
+    def test_weighted_choices(self):
+        random.seed(7)
+        choices = weighted_choices(self.population, 3)
+        weights = dict(self.population)
+        self.assertEqual(len(set(choices)), 3)
+        self.assertEqual(choices, sorted(choices, key=lambda choice: weights[choice], reverse=True))
+
+
+class OccupancyTest(unittest.TestCase):
+    
+    cells = [(1, 1), (1, 5), (2, 3), (3, 4)]
+    
+    def occupancy(self):
+        occupancy = Occupancy((3, 5))
+        for x, y in self.cells:
+            occupancy.occupy(x, y)
+        return occupancy
+    
+    def test_round_trip(self):
+        stored = Occupancy.frombytes(self.occupancy().tobytes())
+        self.assertEqual(stored.size, (3, 5))
+        self.assertEqual(list(stored), self.cells)
+        self.assertEqual(len(stored), len(self.cells))
+        self.assertEqual(len(list(stored.free_cells())), 15 - len(self.cells))
+    
+    def test_old_formats(self):
+        self.assertEqual(list(Occupancy.from_text((3, 5), u"1,1 2,3 1,5 3,4")), self.cells)
+        bits = self.occupancy().tobytes()[-2:]
+        self.assertEqual(list(Occupancy.frombytes(bits, (3, 5))), self.cells)
+        self.assertRaises(ValueError, Occupancy.frombytes, bits)
+        self.assertRaises(ValueError, Occupancy, (10, 10), bytearray(2))
+    
+    def test_field(self):
+        field = OccupancyField(size=(3, 5))
+        stored = field.get_db_prep_value(self.occupancy(), connection=connection)
+        self.assertEqual(list(field.to_python(str(stored))), self.cells)
+        self.assertEqual(list(field.to_python(u"1,1 2,3 1,5 3,4")), self.cells)
+
+
+class QueryPlanTest(TestCase):
+    
+    @unittest.skipUnless(connection.settings_dict["ENGINE"].endswith("sqlite3"), "query plans are SQLite's")
+    def test_hot_queries_use_an_index(self):
+        for name, queryset in hot_queries():
+            self.assertEqual(plan_problems(query_plan(queryset)), [], name)
+
+
+class QueryCountTest(TestCase):
+    
+    def setUp(self):
+        self.clock = clock.SimulatedClock(speed=0)
+        self.real_clock = clock.set_clock(self.clock)
+        user = User.objects.create_user("counted", "counted@example.com", "password")
+        self.player = Player.objects.create(user=user, name="counted")
+        for resource_kind in get_catalog().resource_kind_list(player=True):
+            self.player.playerresourcecount_set.create(kind_id=resource_kind.pk,
+                count=0, natural_rate=0, rate_adjustment=0, limit=0, timestamp=clock.now(),
+            )
+    
+    def tearDown(self):
+        clock.set_clock(self.real_clock)
+    
+    def place(self, name):
+        # the catalog is loaded by setUp so it is not counted here
+        settlement = Settlement(name=name, player=self.player, continent=Continent.objects.get(pk=1))
+        return settlement, count_queries(settlement.place)
+    
+    def test_player_snapshot(self):
+        queries = []
+        for i in range(3):
+            self.place("snapshot%d" % i)
+            self.clock.advance(minutes=1)
+            snapshots = []
+            queries.append(count_queries(lambda: snapshots.append(player_snapshot(self.player))))
+            self.assertEqual(len(snapshots[0]["settlements"]), i + 1)
+        # the settlements, both kinds of timelines and the build queues of
+        # those the scheduler has not been through
+        self.assertEqual(queries, [4, 4, 4])
+    
+    def test_place(self):
+        queries = [self.place("placed%d" % i)[1] for i in range(3)]
+        self.assertTrue(max(queries) <= PLACE_QUERY_LIMIT, queries)
+    
+    def test_queue(self):
+        settlement, _ = self.place("queued")
+        # a neighbor whose terrain the buildings may draw on
+        self.place("neighbor")
+        SettlementResourceCount.objects.filter(settlement=settlement).update(count=10000000)
+        self.clock.advance(minutes=1)
+        kinds = get_catalog().building_kind_list()
+        queries = []
+        for i in range(2 * len(kinds)):
+            grid = SettlementGrid.load(settlement)
+            SX, SY = grid.size
+            x, y = [
+                (x, y) for x in range(1, SX + 1) for y in range(1, SY + 1)
+                if grid.terrain_at(x, y) is None and grid.building_at(x, y) is None
+            ][0]
+            building = SettlementBuilding(settlement=settlement, kind_id=kinds[i % len(kinds)].pk, x=x, y=y)
+            queries.append(count_queries(building.queue))
+        self.assertTrue(max(queries) <= QUEUE_QUERY_LIMIT, queries)
+
+
+class CatalogTest(TestCase):
+    
+    def test_edit_reloads(self):
+        loaded = get_catalog()
+        kind = ResourceKind.objects.get(pk=loaded.resource_kind_list()[0].pk)
+        kind.name = "renamed"
+        kind.save()
+        self.assertNotEqual(get_catalog(), loaded)
+        self.assertEqual(get_catalog().resource_kinds[kind.pk].name, "renamed")
+    
+    def test_edit_elsewhere_reloads_after_interval(self):
+        loaded = get_catalog()
+        # what invalidating it in another process does
+        CatalogVersion.objects.get_or_create(pk=catalog.VERSION_PK)
+        CatalogVersion.objects.filter(pk=catalog.VERSION_PK).update(version=F("version") + 1)
+        interval = catalog.VERSION_CHECK_INTERVAL
+        try:
+            catalog.VERSION_CHECK_INTERVAL = 3600
+            request_started.send(sender=self.__class__)
+            self.assertEqual(get_catalog(), loaded)
+            catalog.VERSION_CHECK_INTERVAL = 0
+            request_started.send(sender=self.__class__)
+            self.assertNotEqual(get_catalog(), loaded)
+        finally:
+            catalog.VERSION_CHECK_INTERVAL = interval
+            request_finished.send(sender=self.__class__)
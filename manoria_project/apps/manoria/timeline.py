@@ -0,0 +1,425 @@
+import array
+import bisect
+import datetime
+
+from decimal import Decimal
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from manoria import clock
+
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def to_microseconds(when):
+    """
+    Converts a naive datetime into microseconds since EPOCH. Values stay well
+    below 2**53 so they are stored exactly in a double.
+    """
+    delta = when - EPOCH
+    return float((delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds)
+
+
+def from_microseconds(us):
+    return EPOCH + datetime.timedelta(microseconds=us)
+
+
+def to_hours(when):
+    return to_microseconds(when) / 3600000000.0
+
+
+class LinearAmount(object):
+    """
+    The amount() of anything growing linearly from count at timestamp at
+    rate per hour, clamped at zero and at limit (a limit of zero meaning
+    unbounded). Shared by resource count rows, timeline entries and
+    leaderboard entries so they all agree.
+    """
+    
+    __slots__ = []
+    
+    def amount(self, when=None):
+        """
+        At the given time or now, return the amount of which this resource
+        count is reporting. Normally called after getting the current resource
+        count.
+        """
+        if when is None:
+            when = clock.now()
+        change = when - self.timestamp
+        amt = int(self.count + float(self.rate) * (change.days * 86400 + change.seconds) / 3600.0)
+        if self.limit == 0:
+            return max(0, amt)
+        else:
+            return min(max(0, amt), self.limit)
+
+
+class AmountEvaluator(object):
+    """
+    Evaluates LinearAmount.amount for many rows at once (whole-world passes
+    such as refreshing the leaderboard). The rows are held as parallel
+    arrays and, when NumPy is installed, every amount is computed in a
+    single vectorized pass; otherwise a plain loop with the same arithmetic
+    is used.
+    """
+    
+    def __init__(self, counts, rates, timestamps, limits):
+        counts = [float(count) for count in counts]
+        rates = [float(rate) for rate in rates]
+        timestamps = [to_microseconds(timestamp) for timestamp in timestamps]
+        limits = list(limits)
+        if numpy is not None:
+            self.counts = numpy.array(counts, dtype=numpy.float64)
+            self.rates = numpy.array(rates, dtype=numpy.float64)
+            self.timestamps = numpy.array(timestamps, dtype=numpy.float64)
+            self.limits = numpy.array(limits, dtype=numpy.int64)
+        else:
+            self.counts = array.array("d", counts)
+            self.rates = array.array("d", rates)
+            self.timestamps = array.array("d", timestamps)
+            self.limits = array.array("l", limits)
+    
+    def __len__(self):
+        return len(self.counts)
+    
+    @classmethod
+    def of(cls, rows):
+        """
+        An evaluator for anything with count, rate, timestamp and limit
+        (resource count rows, leaderboard entries).
+        """
+        rows = list(rows)
+        return cls(
+            [row.count for row in rows],
+            [row.rate for row in rows],
+            [row.timestamp for row in rows],
+            [row.limit for row in rows],
+        )
+    
+    def amounts(self, when=None):
+        """
+        The amount of every row at the given time (or now), in row order.
+        """
+        if when is None:
+            when = clock.now()
+        when = to_microseconds(when)
+        if numpy is None:
+            return [
+                self._amount(count, rate, timestamp, limit, when)
+                for count, rate, timestamp, limit
+                in zip(self.counts, self.rates, self.timestamps, self.limits)
+            ]
+        # whole seconds elapsed, truncated like timedelta days/seconds
+        seconds = numpy.floor_divide(when - self.timestamps, 1000000)
+        amts = numpy.trunc(self.counts + self.rates * seconds / 3600.0).astype(numpy.int64)
+        amts = numpy.maximum(amts, 0)
+        # a limit of zero means the count is unbounded
+        return numpy.where(self.limits == 0, amts, numpy.minimum(amts, self.limits)).tolist()
+    
+    @staticmethod
+    def _amount(count, rate, timestamp, limit, when):
+        amt = int(count + rate * ((when - timestamp) // 1000000) / 3600.0)
+        if limit == 0:
+            return max(0, amt)
+        else:
+            return min(max(0, amt), limit)
+
+
+class TimelineEntry(LinearAmount):
+    """
+    A single point on a compiled timeline. Quacks like a BaseResourceCount
+    (count, timestamp, natural_rate, rate_adjustment, limit, rate and
+    amount()) so code written against resource count rows can take either.
+    """
+    
+    __slots__ = ["id", "timestamp", "count", "natural_rate", "rate_adjustment", "limit"]
+    
+    def __init__(self, id, timestamp, count, natural_rate, rate_adjustment, limit):
+        self.id = id
+        self.timestamp = timestamp
+        self.count = count
+        self.natural_rate = natural_rate
+        self.rate_adjustment = rate_adjustment
+        self.limit = limit
+    
+    @property
+    def rate(self):
+        return self.natural_rate + self.rate_adjustment
+
+
+class ResourceTimeline(object):
+    """
+    The full history and future of one resource kind on one owner compiled
+    into parallel arrays ordered by timestamp. Point lookups are answered by
+    bisection rather than by querying the database.
+    
+    Rows sharing a timestamp keep their insertion (id) order so the last one
+    written is the one considered current, as with current_many.
+    """
+    
+    def __init__(self, rows=()):
+        self.ids = array.array("l")
+        self.timestamps = array.array("d")
+        self.counts = array.array("l")
+        self.natural_rates = array.array("d")
+        self.rate_adjustments = array.array("d")
+        self.limits = array.array("l")
+        self._events = None
+        for row in rows:
+            self.insert(row)
+    
+    def __len__(self):
+        return len(self.timestamps)
+    
+    @classmethod
+    def load(cls, ResourceCount, owner, kind):
+        """
+        Compiles the timeline of the given kind on owner with a single query.
+        """
+        lookup_params = {
+            "kind": kind,
+            ResourceCount.owner_field: owner,
+        }
+        rows = ResourceCount._default_manager.filter(**lookup_params)
+        return cls(rows.order_by("timestamp", "id"))
+    
+    def insert(self, row):
+        """
+        Adds a resource count row (or anything with the same attributes) in
+        timestamp order. Used to keep a loaded timeline in step with rows
+        written after it was compiled.
+        """
+        ts = to_microseconds(row.timestamp)
+        i = bisect.bisect_right(self.timestamps, ts)
+        self.ids.insert(i, row.id or 0)
+        self.timestamps.insert(i, ts)
+        self.counts.insert(i, row.count)
+        self.natural_rates.insert(i, float(row.natural_rate))
+        self.rate_adjustments.insert(i, float(row.rate_adjustment))
+        self.limits.insert(i, row.limit)
+        self._events = None
+    
+    def index(self, when=None):
+        """
+        Position of the current entry at the given time (the last one with a
+        timestamp strictly before when). Raises IndexError if there is none,
+        just like BaseResourceCount.current.
+        """
+        if when is None:
+            when = clock.now()
+        i = bisect.bisect_left(self.timestamps, to_microseconds(when)) - 1
+        if i < 0:
+            raise IndexError("no resource count before %s" % when)
+        return i
+    
+    def entry(self, i):
+        return TimelineEntry(
+            id=self.ids[i],
+            timestamp=from_microseconds(self.timestamps[i]),
+            count=self.counts[i],
+            natural_rate=Decimal("%.1f" % self.natural_rates[i]),
+            rate_adjustment=Decimal("%.1f" % self.rate_adjustments[i]),
+            limit=self.limits[i],
+        )
+    
+    def index_after(self, when):
+        """
+        Position of the first entry with a timestamp strictly after when
+        (len(self) if there is none).
+        """
+        return bisect.bisect_right(self.timestamps, to_microseconds(when))
+    
+    def adjust(self, start, count=0, rate_adjustment=0):
+        """
+        Adds to the count and rate adjustment of every entry from position
+        start onwards, as an F() update of the same rows would. Returns the
+        ids of the entries adjusted.
+        """
+        for i in xrange(start, len(self.timestamps)):
+            self.counts[i] += count
+            self.rate_adjustments[i] += float(rate_adjustment)
+        self._events = None
+        return list(self.ids[start:])
+    
+    def current(self, when=None):
+        return self.entry(self.index(when))
+    
+    def rate(self, when=None):
+        i = self.index(when)
+        return self.natural_rates[i] + self.rate_adjustments[i]
+    
+    def amount(self, when=None):
+        """
+        The amount at the given time; same arithmetic as
+        BaseResourceCount.amount on the current row.
+        """
+        if when is None:
+            when = clock.now()
+        i = self.index(when)
+        # whole seconds elapsed, truncated like timedelta days/seconds
+        seconds = (to_microseconds(when) - self.timestamps[i]) // 1000000
+        rate = self.natural_rates[i] + self.rate_adjustments[i]
+        amt = int(self.counts[i] + rate * seconds / 3600.0)
+        limit = self.limits[i]
+        if limit == 0:
+            return max(0, amt)
+        else:
+            return min(max(0, amt), limit)
+    
+    def next_change(self, when=None):
+        """
+        The timestamp of the first entry after the given time, or None.
+        """
+        if when is None:
+            when = clock.now()
+        i = self.index_after(when)
+        if i == len(self.timestamps):
+            return None
+        return from_microseconds(self.timestamps[i])
+    
+    def _compile_events(self):
+        """
+        For every segment work out where (if anywhere inside the segment) the
+        count runs out or hits its limit, then link each position to the
+        first segment at or after it which has such an event.
+        """
+        n = len(self.timestamps)
+        times = [None] * n
+        hits = [None] * n
+        for i in xrange(n):
+            rate = self.natural_rates[i] + self.rate_adjustments[i]
+            count = self.counts[i]
+            if rate < 0:
+                hours, hit_limit = count / -rate, False
+            elif rate > 0:
+                hours, hit_limit = (self.limits[i] - count) / rate, True
+            else:
+                continue
+            ts = self.timestamps[i] + round(hours * 3600000000)
+            if i + 1 < n and ts > self.timestamps[i + 1]:
+                continue
+            times[i], hits[i] = ts, hit_limit
+        following = [None] * (n + 1)
+        for i in xrange(n - 1, -1, -1):
+            following[i] = i if times[i] is not None else following[i + 1]
+        self._events = (times, hits, following)
+        return self._events
+    
+    def next_extremum(self, when=None):
+        """
+        Timeline counterpart of BaseResourceCount.calculate_extremum: returns
+        (timestamp, hit_limit) for the next point where the count runs out
+        (False) or hits its limit (True) or (None, None).
+        """
+        i = self.index(when)
+        times, hits, following = self._events or self._compile_events()
+        j = following[i]
+        if j is None:
+            return None, None
+        return from_microseconds(times[j]), hits[j]
+
+
+class TimelineCache(object):
+    """
+    Compiled timelines shared for the lifetime of a request (or any other
+    unit of work). Timelines are keyed by resource count class, owner and
+    kind and loaded on first use.
+    """
+    
+    def __init__(self):
+        self._timelines = {}
+    
+    def _key(self, ResourceCount, owner_id, kind_id):
+        return (ResourceCount, owner_id, kind_id)
+    
+    def get(self, ResourceCount, owner, kind):
+        key = self._key(ResourceCount, owner.pk, kind.pk)
+        try:
+            return self._timelines[key]
+        except KeyError:
+            timeline = ResourceTimeline.load(ResourceCount, owner, kind)
+            self._timelines[key] = timeline
+            return timeline
+    
+    def prefetch(self, ResourceCount, owners, kinds=None):
+        """
+        Loads the timelines of every kind (or of the given kinds) on every
+        owner with a single query. Timelines already loaded are kept as they
+        are and no query is made when all of the given kinds are. Returns the
+        timelines keyed by (owner pk, kind pk).
+        """
+        owner_field = ResourceCount.owner_field
+        loaded = {}
+        if kinds is not None:
+            wanted = [(owner, kind) for owner in owners for kind in kinds]
+            for owner, kind in wanted:
+                timeline = self._timelines.get(self._key(ResourceCount, owner.pk, kind.pk))
+                if timeline is not None:
+                    loaded[(owner.pk, kind.pk)] = timeline
+            missing = [(owner, kind) for owner, kind in wanted if (owner.pk, kind.pk) not in loaded]
+            if not missing:
+                return loaded
+            owners = dict([(owner.pk, owner) for owner, _ in missing]).values()
+            kinds = dict([(kind.pk, kind) for _, kind in missing]).values()
+        lookup_params = {
+            "%s__in" % owner_field: owners,
+        }
+        if kinds is not None:
+            lookup_params["kind__in"] = [kind.pk for kind in kinds]
+        rows = ResourceCount._default_manager.filter(**lookup_params)
+        rows = rows.order_by("timestamp", "id")
+        fetched = {}
+        for row in rows:
+            key = (getattr(row, "%s_id" % owner_field), row.kind_id)
+            fetched.setdefault(key, ResourceTimeline()).insert(row)
+        if kinds is not None:
+            # remember that these owners have no rows of the missing kinds
+            for owner in owners:
+                for kind in kinds:
+                    fetched.setdefault((owner.pk, kind.pk), ResourceTimeline())
+        for (owner_id, kind_id), timeline in fetched.iteritems():
+            key = self._key(ResourceCount, owner_id, kind_id)
+            loaded[(owner_id, kind_id)] = self._timelines.setdefault(key, timeline)
+        return loaded
+    
+    def record(self, row):
+        """
+        Makes a freshly written resource count row visible to an already
+        loaded timeline.
+        """
+        ResourceCount = type(row)
+        owner_id = getattr(row, "%s_id" % ResourceCount.owner_field)
+        timeline = self._timelines.get(self._key(ResourceCount, owner_id, row.kind_id))
+        if timeline is not None:
+            timeline.insert(row)
+    
+    def invalidate(self, ResourceCount, owner, kind):
+        """
+        Drops a loaded timeline (owner and kind may be given as primary keys)
+        so it is compiled afresh when next read.
+        """
+        key = self._key(ResourceCount, getattr(owner, "pk", owner), getattr(kind, "pk", kind))
+        self._timelines.pop(key, None)
+
+
+def first_change(timelines, when):
+    """
+    The first point after when at which any of the given timelines changes
+    rate, runs out or hits its limit (None if none of them will).
+    """
+    changes = []
+    for timeline in timelines:
+        changes.append(timeline.next_change(when))
+        try:
+            extremum, _ = timeline.next_extremum(when)
+        except IndexError:
+            continue
+        changes.append(extremum)
+    changes = [change for change in changes if change is not None and change > when]
+    if changes:
+        return min(changes)
+    return None
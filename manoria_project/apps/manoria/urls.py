@@ -18,10 +18,14 @@ urlpatterns = patterns("",
     url(r"^leaderboard/$", "manoria.views.leaderboard", name="leaderboard"),
     
     url(r"^ajax_resource_count/(\d+)/$", "manoria.views.ajax_resource_count", name="ajax_resource_count"),
+    url(r"^ajax_player_resource_count/$", "manoria.views.ajax_player_resource_count", name="ajax_player_resource_count"),
+    url(r"^stream_resource_count/(\d+)/$", "manoria.views.stream_resource_count", name="stream_resource_count"),
     url(r"^fragment_resource_count/(\d+)/$", "manoria.views.fragment_resource_count", name="fragment_resource_count"),
     url(r"^fragment_build_queue/(\d+)/$", "manoria.views.fragment_build_queue", name="fragment_build_queue"),
     url(r"^fragment_settlement_map/(\d+)/$", "manoria.views.fragment_settlement_map", name="fragment_settlement_map"),
     
+    url(r"^stats/$", "manoria.views.instrumentation_stats", name="instrumentation_stats"),
+    
     url(r"^help/$", direct_to_template, {"template": "manoria/help_index.html"}, name="help_index"),
     url(r"^help/terrain/$", "manoria.views.terrain_kind_list", name="help_terrain"),
     url(r"^help/resources/$", "manoria.views.resource_kind_list", name="help_resources"),
@@ -1,17 +1,209 @@
 import random
 
+from django.db import connection, transaction
+from django.db.models import AutoField
+
+
+def bulk_insert(model, objs):
+    """
+    Inserts unsaved model instances with a single executemany. Primary keys
+    are not set on the instances and no signals are sent, so this is only
+    for freshly generated rows nothing else is watching.
+    """
+    if not objs:
+        return
+    qn = connection.ops.quote_name
+    fields = [f for f in model._meta.local_fields if not isinstance(f, AutoField)]
+    sql = "INSERT INTO %s (%s) VALUES (%s)" % (
+        qn(model._meta.db_table),
+        ", ".join([qn(f.column) for f in fields]),
+        ", ".join(["%s"] * len(fields)),
+    )
+    params = [
+        [f.get_db_prep_save(f.pre_save(obj, True), connection=connection) for f in fields]
+        for obj in objs
+    ]
+    connection.cursor().executemany(sql, params)
+    transaction.set_dirty()
+
+
+class WritePlan(object):
+    """
+    Rows to insert and per-row increments collected while working out a
+    change, then written by apply() with one executemany per model and kind
+    of write. Like bulk_insert no signals are sent and primary keys are not
+    set, so callers take care of whatever the signals would have done.
+    """
+    
+    def __init__(self):
+        self.inserts = []
+        self.increments = []
+    
+    def insert(self, obj):
+        self.inserts.append(obj)
+        return obj
+    
+    def increment(self, model, pks, **deltas):
+        """
+        Adds the given deltas (field name to amount) to the rows of model
+        with the given primary keys.
+        """
+        for pk in pks:
+            self.increments.append((model, pk, deltas))
+    
+    def apply(self):
+        inserts = {}
+        for obj in self.inserts:
+            inserts.setdefault(type(obj), []).append(obj)
+        for model, objs in inserts.iteritems():
+            bulk_insert(model, objs)
+        # rows touched more than once get their deltas summed
+        increments = {}
+        for model, pk, deltas in self.increments:
+            row = increments.setdefault(model, {}).setdefault(pk, {})
+            for name, delta in deltas.iteritems():
+                row[name] = row.get(name, 0) + delta
+        for model, rows in increments.iteritems():
+            bulk_increment(model, rows)
+        self.inserts, self.increments = [], []
+
+
+def bulk_increment(model, rows):
+    """
+    Adds deltas to numeric columns of many rows with a single executemany.
+    rows maps primary keys to dicts of field name to delta; fields missing
+    from a row are left as they are.
+    """
+    if not rows:
+        return
+    qn = connection.ops.quote_name
+    names = sorted(set([name for deltas in rows.itervalues() for name in deltas]))
+    fields = [model._meta.get_field(name) for name in names]
+    sql = "UPDATE %s SET %s WHERE %s = %%s" % (
+        qn(model._meta.db_table),
+        ", ".join(["%s = %s + %%s" % (qn(f.column), qn(f.column)) for f in fields]),
+        qn(model._meta.pk.column),
+    )
+    params = [
+        [deltas.get(name, 0) for name in names] + [pk]
+        for pk, deltas in sorted(rows.iteritems())
+    ]
+    connection.cursor().executemany(sql, params)
+    transaction.set_dirty()
+
+
+def bulk_delete(model, pks):
+    """
+    Deletes the rows of model with the given primary keys with a single
+    DELETE. Unlike QuerySet.delete the rows are not loaded first and no
+    signals are sent (or related rows collected), so callers take care of
+    whatever the signals would have done.
+    """
+    if not pks:
+        return
+    qn = connection.ops.quote_name
+    sql = "DELETE FROM %s WHERE %s IN (%s)" % (
+        qn(model._meta.db_table),
+        qn(model._meta.pk.column),
+        ", ".join(["%s"] * len(pks)),
+    )
+    connection.cursor().execute(sql, list(pks))
+    transaction.set_dirty()
+
+
+def bulk_update(model, field_name, values):
+    """
+    Sets one field of many rows with a single executemany; values are
+    (primary key, value) pairs. Like bulk_insert no signals are sent.
+    """
+    if not values:
+        return
+    qn = connection.ops.quote_name
+    field = model._meta.get_field(field_name)
+    sql = "UPDATE %s SET %s = %%s WHERE %s = %%s" % (
+        qn(model._meta.db_table),
+        qn(field.column),
+        qn(model._meta.pk.column),
+    )
+    params = [[field.get_db_prep_save(value, connection=connection), pk] for pk, value in values]
+    connection.cursor().executemany(sql, params)
+    transaction.set_dirty()
+
+
+class WeightedSampler(object):
+    """
+    Draws from a weighted population of (choice, weight) pairs. Built once
+    per weight vector; each draw is proportional to weight and k draws
+    without replacement cost O(k log n) regardless of the size of the
+    weights.
+    
+    The weights are held in a Fenwick (binary indexed) tree so a draw is a
+    descent to the first cumulative weight above a random point and taking
+    a choice out is a point update. Given the same random stream it picks
+    exactly what expanding the population into one entry per unit of
+    weight and choosing from that list would.
+    """
+    
+    def __init__(self, weighted_population):
+        self.choices = []
+        self.weights = []
+        for choice, weight in weighted_population:
+            self.choices.append(choice)
+            self.weights.append(weight)
+        n = len(self.weights)
+        self.tree = [0] + list(self.weights)
+        for i in range(1, n + 1):
+            parent = i + (i & -i)
+            if parent <= n:
+                self.tree[parent] += self.tree[i]
+        self.total = sum(self.weights)
+        self.top = 1
+        while self.top * 2 <= n:
+            self.top *= 2
+    
+    def __len__(self):
+        return len(self.choices)
+    
+    def _add(self, index, delta):
+        i = index + 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+        self.total += delta
+    
+    def _find(self, point):
+        # position of the first choice whose cumulative weight exceeds point
+        position, bit = 0, self.top
+        while bit:
+            following = position + bit
+            if following < len(self.tree) and self.tree[following] <= point:
+                position = following
+                point -= self.tree[following]
+            bit >>= 1
+        return position
+    
+    def draw(self, rng=random):
+        """
+        A single draw (with replacement).
+        """
+        return self.choices[self._find(rng.random() * self.total)]
+    
+    def sample(self, k, rng=random):
+        """
+        Up to k distinct choices in the order drawn, without replacement.
+        The sampler is left as it was so it can be reused.
+        """
+        taken = []
+        while len(taken) < k and self.total > 0:
+            index = self._find(rng.random() * self.total)
+            taken.append(index)
+            self._add(index, -self.weights[index])
+        for index in taken:
+            self._add(index, self.weights[index])
+        return [self.choices[index] for index in taken]
+
 
 def weighted_choices(weighted_population, k):
-    s = []
-    for choice, weight in weighted_population:
-        for i in range(weight):
-            s.append(choice)
-    results = []
-    while s:
-        r = random.choice(s)
-        results.append(r)
-        if len(results) == k:
-            break
-        s = [item for item in s if item != r]
+    results = WeightedSampler(weighted_population).sample(k)
     d = dict(weighted_population)
     return sorted(results, key=lambda x: d[x], reverse=True)
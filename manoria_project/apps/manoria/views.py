@@ -1,15 +1,59 @@
-import datetime
-
+from django.conf import settings
+from django.forms.forms import NON_FIELD_ERRORS
 from django.http import Http404, HttpResponse
 from django.template import RequestContext
 from django.shortcuts import get_object_or_404, render_to_response, redirect
 from django.utils import simplejson as json
+from django.utils.cache import patch_cache_control
+from django.utils.functional import wraps
+from django.views.decorators.http import condition
 
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
 
+from manoria import clock
+from manoria.catalog import get_catalog
 from manoria.forms import PlayerCreateForm, SettlementCreateForm, BuildingCreateForm
-from manoria.models import Continent, Player, Settlement, SettlementBuilding, SettlementTerrain, ResourceKind, BuildingKind, SettlementTerrainKind
-from manoria.models import SettlementResourceCount, PlayerResourceCount
+from manoria.instrumentation import stats
+from manoria.models import Continent, ContinentFull, Player, Settlement, SettlementBuilding, SettlementTerrain, ResourceKind, BuildingKind, SettlementTerrainKind
+from manoria.models import SettlementResourceCount, PlayerResourceCount, LeaderboardEntry
+from manoria.snapshots import player_snapshot, resource_snapshot
+from manoria.streaming import event_stream, scheduler
+from manoria.timeline import to_microseconds
+
+
+LEADERBOARD_PAGE_SIZE = 25
+
+
+def settlement_condition(owner_only=True):
+    """
+    Answers conditional GETs for a settlement's polled endpoints with a 304
+    when its state still matches. The ETag comes from the stored version
+    and next change alone, which the scheduler (run_scheduler) bumps as
+    scheduled changes come due, so a 304 costs the one query loading the
+    settlement. The view is called with that settlement rather than its
+    primary key; other players get a 404 unless owner_only is off.
+    """
+    def decorator(view):
+        def inner(request, settlement_pk):
+            settlement = get_object_or_404(Settlement.objects.select_related("player"), pk=settlement_pk)
+            if owner_only and request.user.id != settlement.player.user_id:
+                raise Http404
+            if settlement.next_change is None:
+                etag = "settlement-%d-%d" % (settlement.pk, settlement.version)
+            else:
+                etag = "settlement-%d-%d-%d" % (settlement.pk, settlement.version,
+                    to_microseconds(settlement.next_change)
+                )
+            conditional_view = condition(etag_func=lambda request, settlement_pk: etag)(
+                lambda request, settlement_pk: view(request, settlement)
+            )
+            response = conditional_view(request, settlement_pk)
+            # always revalidate rather than trust a heuristic freshness
+            patch_cache_control(response, no_cache=True)
+            return response
+        return wraps(view)(inner)
+    return decorator
 
 
 def homepage(request):
@@ -26,7 +70,7 @@ def homepage(request):
 
 def _player_detail(request, player):
     continent = get_object_or_404(Continent, pk=1)
-
+    
     ctx = {
         "player": player,
         "continent": continent,
@@ -45,14 +89,14 @@ def player_create(request):
             player.user = request.user
             player.save()
             
-            for resource_kind in ResourceKind.objects.filter(player=True):
+            for resource_kind in get_catalog().resource_kind_list(player=True):
                 player.playerresourcecount_set.create(
-                    kind=resource_kind,
+                    kind_id=resource_kind.pk,
                     count=0,
                     natural_rate=0,
                     rate_adjustment=0,
                     limit=0,
-                    timestamp=datetime.datetime.now(),
+                    timestamp=clock.now(),
                 )
             
             return redirect("home")
@@ -75,6 +119,11 @@ def settlement_detail(request, pk):
     
     ctx = {
         "settlement": settlement,
+        # lets the page line its clock up with the one in ajax responses
+        "server_time": int(to_microseconds(clock.now()) / 1000),
+        # game time may pass faster than real time (see GAME_CLOCK_SPEED)
+        "clock_speed": clock.get_clock().speed,
+        "streaming": settings.RESOURCE_STREAMING,
     }
     ctx = RequestContext(request, ctx)
     return render_to_response("manoria/settlement_detail.html", ctx)
@@ -93,9 +142,15 @@ def settlement_create(request):
             settlement.player = player
             settlement.continent = Continent.objects.get(pk=1)
             
-            settlement.place()
-            
-            return redirect("settlement_detail", settlement.pk)
+            try:
+                settlement.place()
+            except ContinentFull:
+                form._errors[NON_FIELD_ERRORS] = form.error_class([
+                    "%s is full; there is no room for another settlement." % settlement.continent
+                ])
+            else:
+                scheduler.wake(settlement.pk)
+                return redirect("settlement_detail", settlement.pk)
     else:
         form = SettlementCreateForm()
     
@@ -128,14 +183,18 @@ def building_create(request, settlement_pk):
     def buildings():
         resource_counts = {}
         for resource_count in settlement.resource_counts():
-            resource_counts[resource_count.kind] = resource_count
-        for building_kind in BuildingKind.objects.all():
+            resource_counts[resource_count.kind_id] = resource_count
+        for building_kind in get_catalog().building_kind_list():
             fully_sufficient = []
             d = {"building_kind": building_kind, "costs": []}
-            for cost in building_kind.buildingcost_set.all():
-                cost.sufficient = resource_counts[cost.resource_kind].amount() >= cost.amount
-                fully_sufficient.append(cost.sufficient)
-                d["costs"].append(cost)
+            for cost in building_kind.costs:
+                sufficient = resource_counts[cost.resource_kind.pk].amount() >= cost.amount
+                fully_sufficient.append(sufficient)
+                d["costs"].append({
+                    "resource_kind": cost.resource_kind,
+                    "amount": cost.amount,
+                    "sufficient": sufficient,
+                })
             d["sufficient"] = all(fully_sufficient)
             yield d
     
@@ -147,7 +206,8 @@ def building_create(request, settlement_pk):
             
             building.settlement = settlement
             
-            building.queue()
+            building.queue(grid=form.grid)
+            scheduler.wake(settlement.pk)
             
             return redirect("settlement_detail", settlement.pk)
     else:
@@ -207,62 +267,110 @@ def terrain_kind_list(request):
     return render_to_response("manoria/terrain_kind_list.html", ctx)
 
 
-def leaderboard(request):
-    leaders_gold, leaders_building_count = [], []
-    gold = ResourceKind.objects.get(slug="gold")
+class LeaderboardPage(object):
+    """
+    A page of ranked entries, read with one query for a row more than fits
+    to tell whether there is a next page rather than counting every entry
+    like a Paginator page would.
+    """
+    
+    def __init__(self, entries, number, size=LEADERBOARD_PAGE_SIZE):
+        self.number = number
+        self.size = size
+        rows = list(entries[(number - 1) * size:number * size + 1])
+        self.object_list = rows[:size]
+        self._has_next = len(rows) > size
+    
+    def has_next(self):
+        return self._has_next
     
-    for player in Player.objects.all():
-        current = PlayerResourceCount.current(gold, player=player)
-        leaders_gold.append((current.amount(), player))
+    def has_previous(self):
+        return self.number > 1
     
-    for settlement in Settlement.objects.all():
-        total = settlement.build_queue().count() + settlement.buildings().count()
-        leaders_building_count.append((total, settlement))
+    def start_index(self):
+        return (self.number - 1) * self.size + 1
+
+
+def leaderboard(request):
+    # entries are ranked on the values the scheduler last brought up to date
+    # (see LeaderboardEntry.refresh) so nothing is projected here
+    try:
+        page = max(1, int(request.GET.get("page", 1)))
+    except ValueError:
+        page = 1
     
-    leaders_gold = sorted(leaders_gold, reverse=True)
-    leaders_building_count = sorted(leaders_building_count, reverse=True)
+    leaders_gold = LeaderboardPage(LeaderboardEntry.objects.ranked("gold"), page)
+    leaders_building_count = LeaderboardPage(LeaderboardEntry.objects.ranked("buildings"), page)
     
     ctx = {
-        "leaders_gold": leaders_gold,
-        "leaders_building_count": leaders_building_count,
+        "leaders_gold": [(entry.value, entry.leader) for entry in leaders_gold.object_list],
+        "leaders_building_count": [(entry.value, entry.leader) for entry in leaders_building_count.object_list],
+        "gold_page": leaders_gold,
+        "building_count_page": leaders_building_count,
+        "page": page,
     }
+    
+    if request.user.is_authenticated():
+        try:
+            player = request.user.player
+        except Player.DoesNotExist:
+            player = None
+        if player is not None:
+            ctx["player"] = player
+            entries = LeaderboardEntry.objects.filter(player=player)
+            for metric, key in [("gold", "my_gold_rank"), ("buildings", "my_building_count_rank")]:
+                best = entries.filter(metric=metric).order_by("-value")[:1]
+                if best:
+                    ctx[key] = LeaderboardEntry.objects.rank(best[0])
+    
     ctx = RequestContext(request, ctx)
     return render_to_response("manoria/leaderboard.html", ctx)
 
 
-def ajax_resource_count(request, settlement_pk):
-    settlement = get_object_or_404(Settlement, pk=settlement_pk)
+@settlement_condition(owner_only=False)
+def ajax_resource_count(request, settlement):
+    # the amounts are as of the snapshot's timestamp and the rates hold
+    # until its next_change so a response revalidated with a 304 can still
+    # be interpolated from
+    d = resource_snapshot(settlement)
     
-    d = {}
-    
-    future = SettlementResourceCount.objects.filter(
-        settlement=settlement,
-        timestamp__gt=datetime.datetime.now()
-    ).order_by("timestamp")
-    try:
-        change = future[0].timestamp - datetime.datetime.now()
-        d["next_change"] = (change.days * 86400 + change.seconds) * 1000.0
-    except IndexError:
-        d["next_change"] = None
+    return HttpResponse(json.dumps(d, use_decimal=True), mimetype="application/json")
+
+
+@login_required
+def ajax_player_resource_count(request):
+    """
+    The player's resources and those of every one of the player's
+    settlements in one response.
+    """
+    player = get_object_or_404(Player, user=request.user)
     
-    d["resources"] = resources = []
-    for resource_count in settlement.resource_counts():
-        resources.append({
-            "slug": resource_count.kind.slug,
-            "amount": resource_count.amount(),
-            "limit": resource_count.limit,
-            "rate": resource_count.rate,
-        })
+    d = player_snapshot(player)
     
     return HttpResponse(json.dumps(d, use_decimal=True), mimetype="application/json")
 
 
-def fragment_resource_count(request, settlement_pk):
-    settlement = get_object_or_404(Settlement, pk=settlement_pk)
+@login_required
+def stream_resource_count(request, settlement_pk):
+    """
+    Server-sent events with a resource snapshot of the settlement whenever
+    its state changes (and only then) for clients to interpolate between.
+    Only served when RESOURCE_STREAMING is on, and only to its owner.
+    """
+    if not settings.RESOURCE_STREAMING:
+        raise Http404
+    settlement = get_object_or_404(Settlement.objects.select_related("player"), pk=settlement_pk)
     
-    if request.user != settlement.player.user:
+    if request.user.id != settlement.player.user_id:
         raise Http404
     
+    response = HttpResponse(event_stream(settlement.pk), mimetype="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    return response
+
+
+@settlement_condition()
+def fragment_resource_count(request, settlement):
     ctx = {
         "settlement": settlement,
     }
@@ -270,27 +378,32 @@ def fragment_resource_count(request, settlement_pk):
     return render_to_response("manoria/_resource_counts.html", ctx)
 
 
-def fragment_build_queue(request, settlement_pk):
-    settlement = get_object_or_404(Settlement, pk=settlement_pk)
-    
-    if request.user != settlement.player.user:
-        raise Http404
-    
+@settlement_condition()
+def fragment_build_queue(request, settlement):
     ctx = {
         "settlement": settlement,
+        # game time, which timeuntil would otherwise take from the wall clock
+        "now": clock.now(),
     }
     ctx = RequestContext(request, ctx)
     return render_to_response("manoria/_build_queue.html", ctx)
 
 
-def fragment_settlement_map(request, settlement_pk):
-    settlement = get_object_or_404(Settlement, pk=settlement_pk)
-    
-    if request.user != settlement.player.user:
-        raise Http404
-    
+@settlement_condition()
+def fragment_settlement_map(request, settlement):
     ctx = {
         "settlement": settlement,
     }
     ctx = RequestContext(request, ctx)
     return render_to_response("manoria/_settlement_map.html", ctx)
+
+
+@staff_member_required
+def instrumentation_stats(request):
+    """
+    Percentiles of the queries, SQL time, template time and total time of
+    the recent requests to every view (see InstrumentationMiddleware).
+    """
+    response = HttpResponse(json.dumps(stats.summary(), indent=2), mimetype="application/json")
+    patch_cache_control(response, no_cache=True)
+    return response
@@ -0,0 +1,118 @@
+import datetime
+import heapq
+
+from manoria import clock
+from manoria.models import NOTHING_SCHEDULED, LeaderboardEntry, Settlement, SettlementBuilding
+from manoria.signals import building_completed
+
+
+# how often (seconds) the worker looks for settlements that have changed
+# (and so have a new next change) since it last looked
+POLL_INTERVAL = 1
+
+# how often (seconds of game time) the worker brings the values the
+# leaderboard ranks on up to date
+LEADERBOARD_INTERVAL = 60
+
+# settlements refreshed per query; keeps the pk list under SQLite's limit
+# on query parameters
+BATCH_SIZE = 500
+
+
+class Worker(object):
+    """
+    Brings settlements up to date as their scheduled changes (buildings
+    starting and finishing, resource counts changing rate, running out or
+    filling up) become due, rather than when a request next looks at them.
+    
+    Upcoming changes of every settlement are kept in a priority queue; the
+    worker sleeps until the first of them is due (or the next poll for
+    settlements which have changed, whose next change touch() has reset).
+    Refreshing a settlement bumps its state version, which invalidates
+    whatever is cached under the old one (maps, ETags), rolls its building
+    counts over and sends building_completed for every building that has
+    finished since it was last refreshed. Every LEADERBOARD_INTERVAL the
+    leaderboard is refreshed too.
+    
+    Only one worker should run against a database, and nothing else should
+    refresh settlements: the worker only finds out about a change to a
+    settlement from the next change touch() has reset. Requests revalidate
+    polls against the version and next change the worker stores and work
+    out anything else they show with scheduled_state, which saves nothing.
+    """
+    
+    def __init__(self, poll=POLL_INTERVAL):
+        self.poll = poll
+        self._due = []
+        self._scheduled = {}
+        self._refreshed = {}
+        self._leaderboard_due = None
+    
+    def schedule(self, settlement_pk, when):
+        if when is None or when == NOTHING_SCHEDULED:
+            self._scheduled.pop(settlement_pk, None)
+            return
+        if self._scheduled.get(settlement_pk) != when:
+            self._scheduled[settlement_pk] = when
+            heapq.heappush(self._due, (when, settlement_pk))
+    
+    def load(self, now=None):
+        """
+        Queues the next change of every settlement. Buildings which finished
+        before now are not announced.
+        """
+        if now is None:
+            now = clock.now()
+        settlements = Settlement.objects.exclude(next_change=NOTHING_SCHEDULED)
+        for pk, next_change in settlements.values_list("pk", "next_change"):
+            self._refreshed[pk] = now
+            self.schedule(pk, next_change)
+    
+    def step(self, now=None):
+        """
+        Refreshes the settlements which have changed since the last step or
+        have a change due. Returns how many were refreshed.
+        """
+        if now is None:
+            now = clock.now()
+        pks = set(Settlement.objects.filter(next_change__isnull=True).values_list("pk", flat=True))
+        while self._due and self._due[0][0] <= now:
+            when, pk = heapq.heappop(self._due)
+            # superseded entries are left in the heap until they come up
+            if self._scheduled.get(pk) == when:
+                del self._scheduled[pk]
+                pks.add(pk)
+        pks = sorted(pks)
+        for i in range(0, len(pks), BATCH_SIZE):
+            for settlement in Settlement.objects.filter(pk__in=pks[i:i + BATCH_SIZE]):
+                self.refresh(settlement, now)
+        if self._leaderboard_due is None or now >= self._leaderboard_due:
+            LeaderboardEntry.refresh(now)
+            self._leaderboard_due = now + datetime.timedelta(seconds=LEADERBOARD_INTERVAL)
+        return len(pks)
+    
+    def refresh(self, settlement, now):
+        since = self._refreshed.get(settlement.pk, settlement.changed)
+        settlement.refresh_state(now)
+        self._refreshed[settlement.pk] = now
+        if since is not None:
+            completed = SettlementBuilding.objects.filter(
+                settlement=settlement,
+                construction_end__gt=since,
+                construction_end__lte=now,
+            )
+            for building in completed.order_by("construction_end"):
+                building_completed.send(sender=SettlementBuilding, building=building, when=building.construction_end)
+        self.schedule(settlement.pk, settlement.next_change)
+    
+    def delay(self, now=None):
+        """
+        Seconds to sleep before the next step.
+        """
+        if now is None:
+            now = clock.now()
+        if self._due:
+            seconds = clock.get_clock().seconds(self._due[0][0] - now)
+            if seconds is not None:
+                return max(0, min(seconds, self.poll))
+        return self.poll
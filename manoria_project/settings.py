@@ -93,6 +93,7 @@ TEMPLATE_LOADERS = [
 ]
 
 MIDDLEWARE_CLASSES = [
+    "manoria.middleware.InstrumentationMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
@@ -188,6 +189,23 @@ CONTINENT_SIZE = (10, 10)
 SETTLEMENT_SIZE = (10, 10)
 SETTLEMENT_RESOURCE_COUNT = 20
 
+# how many times as fast as real time game time passes (greater than 0);
+# anything but 1 fast-forwards the game (for development databases only, as
+# everything scheduled is then in the real future)
+GAME_CLOCK_SPEED = 1
+
+# the (real) time from which a fast game clock counts, game and real time
+# agreeing then; fixed so every process and restart tells the same game time
+# and required whenever GAME_CLOCK_SPEED is not 1
+GAME_CLOCK_EPOCH = None
+
+# whether settlement pages follow their resources over a server-sent event
+# stream rather than polling; every open page holds a server thread (or
+# process) for as long as its stream is open, so only turn it on behind a
+# server which does not tie up a worker per connection (such as gunicorn
+# with gevent workers), never with runserver
+RESOURCE_STREAMING = False
+
 # local_settings.py can be used to override environment-specific settings
 # like database and email that differ between development and production.
 try: